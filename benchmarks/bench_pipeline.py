@@ -0,0 +1,247 @@
+"""End-to-end benchmark of the whole pipeline, with no GPU, microphone, or network needed.
+
+Runs `python -m live_illustrate` against the local OpenAI stand-in from fake_services.py, compressing a long
+session into a short run: summary intervals are divided by --speedup, and transcript lines (or a WAV file, played
+back in place of the microphone) arrive --speedup times faster than they would at the table.
+
+    python benchmarks/bench_pipeline.py --hours 4 --speedup 480 --viewers 50
+    python benchmarks/bench_pipeline.py --wav session.wav --audio_model tiny.en --speedup 4
+
+While it runs, the process's memory and the pipeline's queue depths are sampled; at the end, /metrics is used to
+report throughput, end-to-end latency, and per-stage timings. The pipeline's own output goes to live_illustrate.log
+in the (temporary) data directory. tiktoken's encoding has to have been downloaded
+(or be in TIKTOKEN_CACHE_DIR) and, with --wav, the Whisper model has to be cached already.
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import typing as t
+from pathlib import Path
+from time import monotonic, sleep
+
+import requests
+from fake_services import FakeOpenAI
+from load_test_viewer import Stats, poll_viewer
+
+REPO_ROOT = Path(__file__).parent.parent
+WORDS = (
+    "the dragon rogue tavern sword gold door trap goblin wizard spell roll initiative bridge river castle king "
+    "night forest cave torch shadow potion arrow shield temple crypt ghost ship storm mountain village"
+).split()
+QUEUE_DEPTH = re.compile(r'^live_illustrate_stage_queue_depth\{stage="(\w+)"\} (\S+)$', re.MULTILINE)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def rss_mb(pid: int) -> float:
+    """Resident memory of a process, from /proc (so Linux only)"""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+def quantile(entry: t.Dict[str, t.Any], q: float) -> float:
+    """Upper bound of the histogram bucket holding the q-th quantile"""
+    target, seen = q * entry["count"], 0
+    for bound, count in entry["buckets"].items():
+        seen += count
+        if seen >= target and count:
+            return float(bound)
+    return 0.0
+
+
+def feed_lines(stdin: t.IO[str], lines_per_second: float, stop: threading.Event) -> int:
+    sent = 0
+    try:
+        while not stop.wait(1 / lines_per_second):
+            stdin.write(" ".join(random.choices(WORDS, k=random.randint(4, 20))) + "\n")
+            stdin.flush()
+            sent += 1
+        stdin.close()
+    except BrokenPipeError:
+        pass  # live_illustrate exited early; that gets reported below
+    return sent
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser("Offline end-to-end pipeline benchmark")
+    parser.add_argument("--hours", default=3.0, type=float, help="Length of the simulated session")
+    parser.add_argument("--speedup", default=360.0, type=float, help="How much faster than real time to run")
+    parser.add_argument("--wait_minutes", default=7.5, type=float, help="Simulated minutes between images")
+    parser.add_argument("--lines_per_minute", default=20.0, type=float, help="Simulated transcript lines per minute")
+    parser.add_argument("--wav", help="Play this recording through the transcriber instead of feeding text lines")
+    parser.add_argument("--audio_model", default="tiny.en")
+    parser.add_argument("--chat_latency", default=0.5, type=float, help="Wall-clock seconds per summary")
+    parser.add_argument("--image_latency", default=2.0, type=float, help="Wall-clock seconds per image")
+    parser.add_argument("--image_size", default="1024x1024")
+    parser.add_argument("--viewers", default=0, type=int, help="Polling viewers to run against the server")
+    parser.add_argument("--sample_seconds", default=1.0, type=float, help="How often to sample memory and queues")
+    parser.add_argument("--output", help="Also write the results here as JSON, for comparing runs")
+    parser.add_argument("pipeline_args", nargs="*", help="Extra arguments for live_illustrate (after --)")
+    args = parser.parse_args()
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    duration = args.hours * 3600 / args.speedup
+    openai_port, server_port = free_port(), free_port()
+    openai = FakeOpenAI(args.chat_latency, args.image_latency)
+    threading.Thread(target=openai.start, kwargs={"port": openai_port}, daemon=True).start()
+
+    data_dir = tempfile.mkdtemp(prefix="bench_pipeline_")
+    command = [
+        sys.executable,
+        "-m",
+        "live_illustrate",
+        "--wait_minutes",
+        str(args.wait_minutes / args.speedup),
+        "--image_size",
+        args.image_size,
+        "--server_port",
+        str(server_port),
+        "--server_host",
+        "127.0.0.1",
+        "--placeholder_url",
+        "",
+        "--data_dir",
+        data_dir,
+        "--metrics_json",
+    ]
+    if args.wav:
+        command += ["--replay_wav", args.wav, "--replay_speed", str(args.speedup), "--audio_model", args.audio_model]
+        command += ["--audio_compute_type", "int8"]
+    else:
+        command += ["--oneshot", "-"]
+    command += args.pipeline_args
+    env = dict(os.environ, OPENAI_BASE_URL=f"http://127.0.0.1:{openai_port}/v1", OPENAI_API_KEY="benchmark")
+    env.pop("DISCORD_WEBHOOK", None)
+    log = open(Path(data_dir).joinpath("live_illustrate.log"), "w")
+    process = subprocess.Popen(
+        command, cwd=REPO_ROOT, env=env, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=log, text=True
+    )
+    url = f"http://127.0.0.1:{server_port}"
+    while process.poll() is None:
+        try:
+            requests.get(f"{url}/latest", timeout=1)
+            break
+        except requests.RequestException:
+            sleep(0.2)
+    else:
+        sys.exit(f"live_illustrate exited with {process.returncode} before it started serving, see {log.name}")
+    start = monotonic()
+
+    stop = threading.Event()
+    sent: t.List[int] = []
+    if not args.wav:
+        lines_per_second = args.lines_per_minute * args.speedup / 60
+        stdin = process.stdin
+        assert stdin is not None
+        feeder = threading.Thread(target=lambda: sent.append(feed_lines(stdin, lines_per_second, stop)))
+        feeder.start()
+    viewer_stats = Stats()
+    for _ in range(args.viewers):
+        threading.Thread(target=poll_viewer, args=(url, 5.0, stop, viewer_stats), daemon=True).start()
+
+    samples: t.List[t.Tuple[float, float, t.Dict[str, float]]] = []
+    while (elapsed := monotonic() - start) < duration and process.poll() is None:
+        try:
+            depths = {stage: float(depth) for stage, depth in QUEUE_DEPTH.findall(requests.get(f"{url}/metrics").text)}
+        except requests.RequestException:
+            depths = {}
+        samples.append((elapsed, rss_mb(process.pid), depths))
+        sleep(args.sample_seconds)
+
+    stop.set()
+    if not args.wav:
+        feeder.join()
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(timeout=60)
+    except subprocess.TimeoutExpired:
+        process.kill()
+    log.close()
+    metrics_files = list(Path(data_dir).glob("*/metrics.json"))
+    if not metrics_files:
+        sys.exit("live_illustrate didn't write metrics.json")
+    with open(metrics_files[0]) as metricsf:
+        metrics = json.load(metricsf)
+
+    def by_stage(name: str) -> t.Dict[str, t.Any]:
+        return {entry["labels"].get("stage", ""): entry for entry in metrics[name]}
+
+    items, waits, works = by_stage("stage_items_total"), by_stage("stage_wait_seconds"), by_stage("stage_work_seconds")
+    errors = by_stage("stage_errors_total")
+    e2e = metrics["end_to_end_seconds"][0] if metrics["end_to_end_seconds"] else {"count": 0, "buckets": {}}
+    rss = [sample[1] for sample in samples if sample[1]]
+    warm = rss[len(rss) // 10 :] or [0.0]  # ignore start-up when looking for growth
+    results = {
+        "simulated_hours": args.hours,
+        "wall_seconds": round(monotonic() - start, 1),
+        "lines_sent": sent[0] if sent else None,
+        "images": items.get("ImageRenderer", {}).get("value", 0),
+        "summaries": items.get("TextSummarizer", {}).get("value", 0),
+        "images_per_simulated_hour": round(items.get("ImageRenderer", {}).get("value", 0) / args.hours, 2),
+        "summary_input_tokens_mean": (
+            round(metrics["summary_input_tokens"][0]["mean"]) if metrics["summary_input_tokens"] else None
+        ),
+        "end_to_end_p50": quantile(e2e, 0.5) if e2e["count"] else None,
+        "end_to_end_p99": quantile(e2e, 0.99) if e2e["count"] else None,
+        "stages": {
+            stage: {
+                "items": items.get(stage, {}).get("value", 0),
+                "errors": errors.get(stage, {}).get("value", 0),
+                "wait_mean": round(waits[stage]["mean"], 4) if stage in waits else None,
+                "wait_p99": quantile(waits[stage], 0.99) if stage in waits else None,
+                "work_mean": round(works[stage]["mean"], 4) if stage in works else None,
+                "work_p99": quantile(works[stage], 0.99) if stage in works else None,
+                "max_queue": max((sample[2].get(stage, 0.0) for sample in samples), default=0.0),
+            }
+            for stage in sorted(set(items) | set(waits))
+        },
+        "rss_mb_start": round(rss[0], 1) if rss else None,
+        "rss_mb_peak": round(max(rss), 1) if rss else None,
+        "rss_mb_growth": round(warm[-1] - warm[0], 1),
+        "viewer_requests": sum(len(values) for values in viewer_stats.latencies.values()),
+        "viewer_errors": viewer_stats.errors,
+    }
+
+    print(f"{args.hours:g} simulated hours in {results['wall_seconds']}s ({args.speedup:g}x)")
+    print(f"{results['summaries']:.0f} summaries, {results['images']:.0f} images, lines sent: {results['lines_sent']}")
+    print(f"summary input tokens: mean {results['summary_input_tokens_mean']}")
+    print(f"end to end: p50 <= {results['end_to_end_p50']}s  p99 <= {results['end_to_end_p99']}s")
+    for stage, numbers in results["stages"].items():  # type: ignore[attr-defined]
+        print(
+            f"{stage:>16}: {numbers['items']:6.0f} items {numbers['errors']:3.0f} errors  "
+            f"wait mean {numbers['wait_mean']}s p99 <= {numbers['wait_p99']}s  "
+            f"work mean {numbers['work_mean']}s p99 <= {numbers['work_p99']}s  max queue {numbers['max_queue']:.0f}"
+        )
+    print(
+        f"RSS: {results['rss_mb_start']} MB at start, {results['rss_mb_peak']} MB peak, "
+        f"{results['rss_mb_growth']} MB growth after warm-up"
+    )
+    if args.viewers:
+        print(f"viewers: {results['viewer_requests']} requests, {results['viewer_errors']} errors")
+    if args.output:
+        with open(args.output, "w") as outf:
+            json.dump(results, outf, indent=2)
+
+
+if __name__ == "__main__":
+    main()
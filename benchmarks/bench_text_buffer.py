@@ -0,0 +1,71 @@
+"""Compares TextBuffer's indexed context selection against re-tokenizing with get_last_n_tokens.
+
+    python benchmarks/bench_text_buffer.py --lines 10000
+"""
+
+import argparse
+import random
+import typing as t
+from time import perf_counter
+
+from live_illustrate.text_buffer import TextBuffer
+from live_illustrate.util import (
+    Transcription,
+    get_last_n_tokens,
+    num_tokens_from_string,
+)
+
+WORDS = "the party sneaks past goblin guard into dark cavern where dragon sleeps on gold hoard roll for stealth".split()
+
+
+def make_lines(count: int, seed: int = 0) -> t.List[str]:
+    rng = random.Random(seed)
+    return [" ".join(rng.choices(WORDS, k=rng.randint(3, 25))) for _ in range(count)]
+
+
+def legacy_context(lines: t.List[str], max_context: int, persistence: float) -> t.Tuple[str, t.List[str]]:
+    """What TextBuffer.get_context used to do"""
+    context = "\n".join(get_last_n_tokens(lines, max_context))
+    kept = get_last_n_tokens(lines, int(persistence * num_tokens_from_string("\n".join(lines))))
+    return context, kept
+
+
+def indexed_context(lines: t.List[str], max_context: int, persistence: float) -> t.Tuple[str, t.List[str]]:
+    buffer = TextBuffer(wait_minutes=1, max_context=max_context, persistence=persistence)
+    for line in lines:
+        buffer.work(Transcription(line))
+    context = buffer.get_context().transcription
+    return context, [line.transcription for line in buffer.buffer]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser("TextBuffer context selection benchmark")
+    parser.add_argument("--lines", default=10_000, type=int, help="Number of transcript lines to buffer")
+    parser.add_argument("--max_context", default=2000, type=int)
+    parser.add_argument("--persistence", default=0.2, type=float)
+    args = parser.parse_args()
+
+    lines = make_lines(args.lines)
+    num_tokens_from_string("warm up the encoding")
+
+    for name, func in (("legacy", legacy_context), ("indexed", indexed_context)):
+        start = perf_counter()
+        context, kept = func(lines, args.max_context, args.persistence)
+        elapsed = perf_counter() - start
+        print(
+            f"{name:>8}: {elapsed:8.3f}s  context={num_tokens_from_string(context)} tokens  "
+            f"kept={len(kept)}/{len(lines)} lines"
+        )
+
+    # The indexed path pays for tokenization up front in work(), so time the selection on its own too
+    buffer = TextBuffer(wait_minutes=1, max_context=args.max_context, persistence=1.0)
+    for line in lines:
+        buffer.work(Transcription(line))
+    start = perf_counter()
+    for _ in range(1000):
+        buffer.get_context()
+    print(f"get_context() on a pre-filled buffer: {(perf_counter() - start) / 1000 * 1e6:.1f}us per call")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Checks DiscordUploader against the webhook stand-in from fake_services.py: an image that fits goes straight
+through, and an oversized one is re-encoded to fit and retried after a 429. Exits non-zero if anything's off.
+
+    python benchmarks/check_discord_upload.py
+"""
+
+import argparse
+import os
+import sys
+import threading
+import typing as t
+from io import BytesIO
+
+from fake_services import FakeDiscordWebhook
+from PIL import Image as PILImage
+from werkzeug.serving import make_server
+
+from live_illustrate.discord_upload import DiscordUploader
+from live_illustrate.util import Image
+
+
+def noise_png(width: int, height: int) -> bytes:
+    """Random pixels, which PNG can't compress, so the image comes out large"""
+    out = BytesIO()
+    PILImage.frombytes("RGB", (width, height), os.urandom(width * height * 3)).save(out, format="PNG")
+    return out.getvalue()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", default=8097, type=int, help="Port for the webhook stand-in")
+    parser.add_argument("--max_bytes", default=200_000, type=int, help="Upload limit to give the uploader")
+    args = parser.parse_args()
+
+    webhook = FakeDiscordWebhook(rate_limit_every=2)  # the second request gets a 429
+    server = make_server("127.0.0.1", args.port, webhook.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    uploader = DiscordUploader(f"http://127.0.0.1:{args.port}/webhook", max_bytes=args.max_bytes)
+
+    small, large = noise_png(64, 64), noise_png(512, 512)
+    failures: t.List[str] = []
+    try:
+        if not uploader.work(Image("", "a small image", small), "small"):
+            failures.append("the small image wasn't uploaded")
+        if not uploader.work(Image("", "a large image", large), "large"):
+            failures.append("the large image wasn't uploaded after being rate limited")
+    finally:
+        uploader.session.close()
+        server.shutdown()
+
+    received = webhook.list_uploads()
+    uploads = {upload["filename"]: upload for upload in received["uploads"]}
+    if received["requests"] != 3:
+        failures.append(f"expected 3 requests (one of them rate limited), got {received['requests']}")
+    if uploads.get("small.png", {}).get("bytes") != len(small):
+        failures.append(f"the small image should have gone up as is, got {uploads.get('small.png')}")
+    if (upload := uploads.get("large.jpeg")) is None or upload["bytes"] > args.max_bytes:
+        failures.append(f"the large image should have been re-encoded to fit, got {upload}")
+
+    print(f"{len(large)} byte PNG uploaded as {upload['bytes'] if upload else '?'} byte JPEG after a 429")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""Checks that reading a recording stops when the transcriber's worker dies partway through, rather than waiting
+forever on a queue nothing is taking from, so --audio_file runs still finish. Exits non-zero if it hangs.
+
+    python benchmarks/check_transcriber_exit.py
+"""
+
+import argparse
+import sys
+import typing as t
+from threading import Thread
+
+import numpy as np
+
+from live_illustrate.audio_sources import AudioFileSource
+from live_illustrate.transcribe import AudioTranscriber
+from live_illustrate.whisper_engine import SAMPLE_RATE
+
+
+class FailingEngine:
+    """Transcribes the first few batches, then fails every one after that, like a model that's run out of memory"""
+
+    def __init__(self, good_batches: int) -> None:
+        self.good_batches: int = good_batches
+        self.batches: int = 0
+
+    def transcribe_batch(self, phrases: t.List[np.ndarray]) -> t.List[str]:
+        self.batches += 1
+        if self.batches > self.good_batches:
+            raise RuntimeError("out of memory")
+        return ["something was said"] * len(phrases)
+
+
+class EndlessRecording(AudioFileSource):
+    """More phrases than will ever be transcribed, without needing a file or the VAD"""
+
+    def phrases(self) -> t.Iterator[t.Tuple[float, np.ndarray]]:
+        for number in range(10_000):
+            self.seconds_read = number + 1.0
+            yield self.seconds_read, np.zeros(SAMPLE_RATE, dtype=np.float32)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--timeout", default=30.0, type=float, help="Seconds to wait for reading to give up")
+    args = parser.parse_args()
+
+    engine = FailingEngine(good_batches=3)
+    transcriber = AudioTranscriber(
+        engine=engine, phrase_timeout=1.0, batch_size=1, source=EndlessRecording("endless.wav")  # type: ignore
+    )
+    transcribed: t.List[str] = []
+    worker = Thread(target=transcriber.start, args=(lambda line: transcribed.append(line),), daemon=True)
+    worker.start()
+
+    finished = transcriber.finished_reading.wait(timeout=args.timeout)
+    print(f"{len(transcribed)} lines transcribed, then {engine.batches - len(transcribed)} failed batches")
+    if worker.is_alive():
+        print("FAIL: the worker should have given up after too many errors")
+        sys.exit(1)
+    if not finished:
+        print(f"FAIL: still reading {args.timeout}s after the worker died")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""Local stand-ins for the network services live_illustrate talks to, so it can be exercised without accounts,
+rate limits, or bills.
+
+    python benchmarks/fake_services.py webhook --port 8099 --rate_limit_every 3
+    DISCORD_WEBHOOK=http://127.0.0.1:8099/webhook illustrate ...
+
+    python benchmarks/fake_services.py openai --port 8098 --chat_latency 2 --image_latency 10
+    OPENAI_BASE_URL=http://127.0.0.1:8098/v1 OPENAI_API_KEY=fake illustrate ...
+
+The webhook accepts Discord-style multipart uploads, records them, and can answer with 429s and 5xxs on a schedule
+to exercise the uploader's retry logic. The OpenAI stand-in answers chat completions with a canned summary and
+image generations with a solid-colored PNG of the requested size, after a configurable delay.
+"""
+
+import argparse
+import json
+import random
+import threading
+import typing as t
+from base64 import b64encode
+from io import BytesIO
+from time import sleep, time
+
+from flask import Flask, Response, request
+from PIL import Image as PILImage
+
+COLORS = ["#264653", "#2a9d8f", "#e9c46a", "#f4a261", "#e76f51", "#6d597a", "#355070", "#b56576"]
+
+
+class FakeDiscordWebhook:
+    """Accepts webhook uploads the way Discord does and keeps track of what it received"""
+
+    def __init__(self, rate_limit_every: int = 0, fail_every: int = 0, latency: float = 0.0) -> None:
+        self.rate_limit_every: int = rate_limit_every
+        self.fail_every: int = fail_every
+        self.latency: float = latency
+        self.requests: int = 0
+        self.uploads: t.List[t.Dict[str, t.Any]] = []
+        self._lock = threading.Lock()
+
+        self.app = Flask(__name__)
+        self.app.add_url_rule("/webhook", "webhook", self.receive, methods=["POST"])
+        self.app.add_url_rule("/uploads", "uploads", self.list_uploads)
+
+    def receive(self) -> Response | t.Tuple[t.Any, ...]:
+        sleep(self.latency)
+        with self._lock:
+            self.requests += 1
+            count = self.requests
+        if self.rate_limit_every and count % self.rate_limit_every == 0:
+            return {"message": "You are being rate limited.", "retry_after": 0.5, "global": False}, 429
+        if self.fail_every and count % self.fail_every == 0:
+            return "Internal Server Error", 502
+
+        upload = request.files.get("files[0]")
+        if upload is None:
+            return {"message": "Cannot send an empty message", "code": 50006}, 400
+        payload = json.loads(request.form.get("payload_json", "{}"))
+        data = upload.read()
+        record = {
+            "filename": upload.filename,
+            "content_type": upload.mimetype,
+            "bytes": len(data),
+            "description": (payload.get("attachments") or [{}])[0].get("description", ""),
+        }
+        with self._lock:
+            self.uploads.append(record)
+        return {"id": str(count), "attachments": [record]}, 200, {"X-RateLimit-Remaining": "4"}
+
+    def list_uploads(self) -> t.Dict[str, t.Any]:
+        with self._lock:
+            return {"requests": self.requests, "uploads": list(self.uploads)}
+
+    def start(self, host: str = "127.0.0.1", port: int = 8099) -> None:
+        self.app.run(host=host, port=port, threaded=True)
+
+
+class FakeOpenAI:
+    """Answers the two OpenAI endpoints live_illustrate uses. Latencies are jittered by +/- `jitter` (a fraction),
+    since the interesting part of a benchmark is usually what happens when responses bunch up."""
+
+    def __init__(self, chat_latency: float = 1.0, image_latency: float = 5.0, jitter: float = 0.25) -> None:
+        self.chat_latency: float = chat_latency
+        self.image_latency: float = image_latency
+        self.jitter: float = jitter
+        self.counts: t.Dict[str, int] = {"chat": 0, "images": 0}
+        self._images: t.Dict[t.Tuple[str, str], str] = {}  # (size, color) -> base64 PNG
+        self._lock = threading.Lock()
+
+        self.app = Flask(__name__)
+        self.app.add_url_rule("/v1/chat/completions", "chat", self.chat_completions, methods=["POST"])
+        self.app.add_url_rule("/v1/images/generations", "images", self.image_generations, methods=["POST"])
+        self.app.add_url_rule("/stats", "stats", lambda: dict(self.counts))
+
+    def _wait(self, latency: float) -> None:
+        sleep(max(0.0, latency * random.uniform(1 - self.jitter, 1 + self.jitter)))
+
+    def chat_completions(self) -> t.Dict[str, t.Any]:
+        body = request.get_json()
+        self._wait(self.chat_latency)
+        with self._lock:
+            self.counts["chat"] += 1
+            count = self.counts["chat"]
+        dialogue = body["messages"][-1]["content"]
+        content = f"- Scene {count}: a tavern, lit by candles\n- {len(dialogue.split())} words of dialogue so far"
+        if "SCENE:" in body["messages"][0]["content"]:  # a rolling summary, which also carries notes forward
+            content = f"SCENE:\nThe party is in a tavern (update {count}).\nILLUSTRATION:\n{content}"
+        return {
+            "id": f"chatcmpl-{count}",
+            "object": "chat.completion",
+            "created": int(time()),
+            "model": body.get("model", "fake"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        }
+
+    def image_generations(self) -> t.Dict[str, t.Any]:
+        body = request.get_json()
+        self._wait(self.image_latency)
+        with self._lock:
+            self.counts["images"] += 1
+            count = self.counts["images"]
+        return {"created": int(time()), "data": [{"b64_json": self._image(body.get("size", "256x256"), count)}]}
+
+    def _image(self, size: str, count: int) -> str:
+        key = (size, COLORS[count % len(COLORS)])
+        if (cached := self._images.get(key)) is None:
+            width, height = (int(side) for side in size.split("x"))
+            out = BytesIO()
+            PILImage.new("RGB", (width, height), key[1]).save(out, format="PNG")
+            cached = self._images[key] = b64encode(out.getvalue()).decode("ascii")
+        return cached
+
+    def start(self, host: str = "127.0.0.1", port: int = 8098) -> None:
+        self.app.run(host=host, port=port, threaded=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser("Fake services for testing live_illustrate locally")
+    subparsers = parser.add_subparsers(dest="service", required=True)
+    webhook = subparsers.add_parser("webhook", help="Stand-in for a Discord webhook, at /webhook")
+    webhook.add_argument("--host", default="127.0.0.1")
+    webhook.add_argument("--port", default=8099, type=int)
+    webhook.add_argument("--rate_limit_every", default=0, type=int, help="Answer every Nth request with a 429")
+    webhook.add_argument("--fail_every", default=0, type=int, help="Answer every Nth request with a 502")
+    webhook.add_argument("--latency", default=0.0, type=float, help="Seconds to wait before answering")
+    openai = subparsers.add_parser("openai", help="Stand-in for the OpenAI API, at /v1")
+    openai.add_argument("--host", default="127.0.0.1")
+    openai.add_argument("--port", default=8098, type=int)
+    openai.add_argument("--chat_latency", default=1.0, type=float, help="Seconds per chat completion")
+    openai.add_argument("--image_latency", default=5.0, type=float, help="Seconds per image generation")
+    args = parser.parse_args()
+
+    if args.service == "webhook":
+        FakeDiscordWebhook(args.rate_limit_every, args.fail_every, args.latency).start(args.host, args.port)
+    elif args.service == "openai":
+        FakeOpenAI(args.chat_latency, args.image_latency).start(args.host, args.port)
+
+
+if __name__ == "__main__":
+    main()
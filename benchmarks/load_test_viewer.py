@@ -0,0 +1,133 @@
+"""Drives many simulated viewers against the image server and reports latency and throughput.
+
+By default this starts its own ImageServer (publishing a synthetic image every few seconds) so it can run without
+the rest of the pipeline:
+
+    python benchmarks/load_test_viewer.py --viewers 300 --backend waitress --threads 128
+
+or point it at a running instance with --url. Most viewers poll /latest and download new images with
+If-None-Match, like the polling fallback does; --sse_viewers hold event streams open, like the viewer page does.
+"""
+
+import argparse
+import os
+import random
+import statistics
+import threading
+import typing as t
+from time import perf_counter, sleep
+
+import requests
+
+from live_illustrate.serve import ImageServer
+from live_illustrate.util import Image
+
+
+class Stats:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.latencies: t.Dict[str, t.List[float]] = {}
+        self.errors: int = 0
+        self.bytes: int = 0
+        self.pushes: int = 0
+
+    def record(self, kind: str, seconds: float, size: int) -> None:
+        with self.lock:
+            self.latencies.setdefault(kind, []).append(seconds)
+            self.bytes += size
+
+    def error(self) -> None:
+        with self.lock:
+            self.errors += 1
+
+
+def poll_viewer(url: str, interval: float, stop: threading.Event, stats: Stats) -> None:
+    session = requests.Session()  # one keep-alive connection per viewer, like a browser tab
+    seen, etag = -1, None
+    sleep(random.random() * interval)  # don't all arrive in lockstep
+    while not stop.is_set():
+        try:
+            start = perf_counter()
+            latest = session.get(f"{url}/latest", timeout=10).json()["id"]
+            stats.record("latest", perf_counter() - start, 0)
+            if latest != seen:
+                start = perf_counter()
+                r = session.get(f"{url}/images/{latest}", headers={"If-None-Match": etag} if etag else {}, timeout=30)
+                r.raise_for_status()
+                stats.record("image", perf_counter() - start, len(r.content))
+                seen, etag = latest, r.headers.get("ETag")
+        except (requests.RequestException, ValueError):
+            stats.error()
+        stop.wait(interval)
+
+
+def sse_viewer(url: str, stop: threading.Event, stats: Stats) -> None:
+    try:
+        with requests.get(f"{url}/events", stream=True, timeout=(10, 60)) as r:
+            r.raise_for_status()
+            for line in r.iter_lines():
+                if stop.is_set():
+                    return
+                if line.startswith(b"event: image"):
+                    with stats.lock:
+                        stats.pushes += 1
+    except requests.RequestException:
+        stats.error()
+
+
+def percentile(values: t.List[float], p: float) -> float:
+    return sorted(values)[min(len(values) - 1, int(p * len(values)))] if values else 0.0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser("Viewer load test")
+    parser.add_argument("--url", help="Server to test. If omitted, a local ImageServer is started")
+    parser.add_argument("--viewers", default=200, type=int, help="Number of polling viewers")
+    parser.add_argument("--sse_viewers", default=20, type=int, help="Number of viewers holding event streams open")
+    parser.add_argument("--interval", default=5.0, type=float, help="Seconds between polls for each viewer")
+    parser.add_argument("--duration", default=30.0, type=float, help="Seconds to run for")
+    parser.add_argument("--backend", default="waitress", choices=["flask", "waitress"])
+    parser.add_argument("--threads", default=64, type=int)
+    parser.add_argument("--port", default=8089, type=int)
+    parser.add_argument("--image_kb", default=3000, type=int, help="Size of the synthetic images")
+    parser.add_argument("--publish_every", default=5.0, type=float, help="Seconds between synthetic images")
+    args = parser.parse_args()
+
+    stop = threading.Event()
+    url = args.url
+    if url is None:
+        server = ImageServer("127.0.0.1", args.port, backend=args.backend, threads=args.threads)
+        threading.Thread(target=server.start, daemon=True).start()
+        url = f"http://127.0.0.1:{args.port}"
+
+        def publish() -> None:
+            while not stop.wait(args.publish_every):
+                server.update_image(Image("", "", os.urandom(args.image_kb * 1024)))
+
+        threading.Thread(target=publish, daemon=True).start()
+        sleep(1)
+
+    stats = Stats()
+    viewers = [
+        threading.Thread(target=poll_viewer, args=(url, args.interval, stop, stats), daemon=True)
+        for _ in range(args.viewers)
+    ] + [threading.Thread(target=sse_viewer, args=(url, stop, stats), daemon=True) for _ in range(args.sse_viewers)]
+    for viewer in viewers:
+        viewer.start()
+    sleep(args.duration)
+    stop.set()
+
+    print(f"{args.viewers} polling + {args.sse_viewers} SSE viewers for {args.duration:.0f}s against {url}")
+    for kind, values in sorted(stats.latencies.items()):
+        print(
+            f"{kind:>7}: {len(values) / args.duration:7.1f} req/s  "
+            f"p50={statistics.median(values) * 1000:7.1f}ms  "
+            f"p95={percentile(values, 0.95) * 1000:7.1f}ms  "
+            f"p99={percentile(values, 0.99) * 1000:7.1f}ms  "
+            f"max={max(values) * 1000:7.1f}ms"
+        )
+    print(f"transferred {stats.bytes / 1e6:.1f} MB, {stats.pushes} SSE pushes, {stats.errors} errors")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,48 @@
 import argparse
 import logging
-from base64 import b64encode
+import re
+import sys
+import typing as t
+from contextlib import ExitStack
+from datetime import timedelta
 from pathlib import Path
 from threading import Thread
-from time import sleep
+from time import time
 from webbrowser import open_new_tab
 
 from dotenv import load_dotenv
 
-from .render import ImageRenderer
-from .serve import ImageServer
-from .session_data import SessionData
-from .summarize import TextSummarizer
-from .text_buffer import TextBuffer
-from .transcribe import AudioTranscriber
-from .util import (
-    Image,
-    Summary,
-    Transcription,
-    download_image,
-    is_transcription_interesting,
-)
+from .cache import DiskCache
+from .clock import AudioClock, SessionClock
+from .metrics import metrics
+from .startup import StartupTimer
+
+# The rest of the pipeline pulls in numpy, soundfile, speech_recognition, flask and the like, so it's only imported
+# once the arguments have been checked, and --help and mistakes in them come back right away
+if t.TYPE_CHECKING:
+    from .imaging import ImageProcessor
+    from .openai_backend import AsyncOpenAIBackend
+    from .render import ImageRenderer
+    from .serve import ImageServer
+    from .summarize import TextSummarizer
+    from .tables import Table
+    from .text_buffer import TextBuffer
+    from .whisper_engine import WhisperEngine, WhisperPool
 
 load_dotenv()
 
 DEFAULT_DATA_DIR = Path(__file__).parent.parent.joinpath("data")
+SHUTDOWN_TIMEOUT = 10.0  # seconds to let each stage finish its queued work on exit
+PLACEHOLDER_TIMEOUT = 10.0  # seconds to wait on --placeholder_url
+TABLE_NAME = re.compile(r"[A-Za-z0-9_-]+")  # it goes in the viewer's URL and the session folder's path
+
+
+def parse_table(spec: str) -> t.Tuple[str, str]:
+    """NAME or NAME=SOURCE, as given to --tables. Raises ValueError if the name won't do."""
+    name, _, source = spec.partition("=")
+    if not TABLE_NAME.fullmatch(name):
+        raise ValueError(f"table names can only have letters, numbers, - and _, not {name!r}")
+    return name, source
 
 
 def get_args() -> argparse.Namespace:
@@ -41,12 +59,73 @@ def get_args() -> argparse.Namespace:
         help="Compute type for audio model, helps reduce memory usage when needed",
         choices=["int8", "float16", "float32"],
     )
+    parser.add_argument(
+        "--audio_batch_size",
+        default=8,
+        type=int,
+        help="Maximum number of queued phrases (and VAD chunks) to transcribe in a single batch",
+    )
+    parser.add_argument(
+        "--transcribe_workers",
+        default=1,
+        type=int,
+        help="Number of processes to run Whisper in, each with its own copy of the model. "
+        "Useful on CPU-only machines where a single decode can't keep up",
+    )
+    parser.add_argument(
+        "--stream_seconds",
+        default=0.0,
+        type=float,
+        help="Transcribe continuously, re-decoding the most recent audio this often (in seconds) instead of "
+        "waiting for a pause. The words not yet settled are served at /partial, for live captions. "
+        "0 disables streaming",
+    )
     parser.add_argument(
         "--wait_minutes",
         default=7.5,
         type=float,
         help="How frequently to summarize the conversation and generate an image",
     )
+    parser.add_argument(
+        "--min_wait_minutes",
+        type=float,
+        help="With --trigger_tokens, how soon after the last image a busy stretch can get the next one. "
+        "Defaults to --wait_minutes, so images never come early",
+    )
+    parser.add_argument(
+        "--trigger_tokens",
+        default=0,
+        type=int,
+        help="Summarize early (but no sooner than --min_wait_minutes) once this many tokens have been said since the "
+        "last summary. 0 disables this",
+    )
+    parser.add_argument(
+        "--min_new_tokens",
+        default=25,
+        type=int,
+        help="Skip an interval if fewer than this many tokens were said in it, e.g. during a break",
+    )
+    parser.add_argument(
+        "--max_similarity",
+        default=1.0,
+        type=float,
+        help="Skip an interval if at least this fraction of the words said in it were in the last summarized context. "
+        "1.0 disables this",
+    )
+    parser.add_argument(
+        "--summary_lead_seconds",
+        default=0.0,
+        type=float,
+        help="Start summarizing this many seconds before each interval ends, then fold in whatever was said in "
+        "the meantime, so the image is ready close to the end of the interval. Costs an extra summary per image. "
+        "0 disables this",
+    )
+    parser.add_argument(
+        "--rolling_summary",
+        action="store_true",
+        help="Summarize only what was said since the last image, along with running notes on the scene, instead of "
+        "re-sending up to --max_context tokens of transcript every time. Keeps summaries cheap in long sessions",
+    )
     parser.add_argument(
         "--phrase_timeout",
         default=0.75,
@@ -87,8 +166,75 @@ def get_args() -> argparse.Namespace:
     parser.add_argument(
         "--image_style", default="vivid", help="How stylized of an image to render", choices=["vivid", "natural"]
     )
+    parser.add_argument(
+        "--image_candidates",
+        default=1,
+        type=int,
+        help="Render this many images at once for each summary and show whichever finishes first. The others are "
+        "saved to the session folder as alternates. Costs this many times as much",
+    )
+    parser.add_argument(
+        "--candidate_styles",
+        nargs="+",
+        choices=["vivid", "natural"],
+        help="Styles to cycle through for the candidates. Defaults to --image_style for all of them",
+    )
+    parser.add_argument(
+        "--openai_backend",
+        default="async",
+        choices=["async", "sync"],
+        help="async makes OpenAI requests from one event loop, with timeouts, retries, and a cap on concurrent "
+        "requests per model. sync uses a blocking client on each stage's thread, as before",
+    )
+    parser.add_argument(
+        "--openai_timeout", default=120.0, type=float, help="Seconds to wait for each OpenAI request (async backend)"
+    )
+    parser.add_argument(
+        "--openai_concurrency",
+        default=2,
+        type=int,
+        help="Most requests to have in flight to each OpenAI model at once (async backend)",
+    )
+    parser.add_argument(
+        "--coalesce",
+        default=True,
+        action=argparse.BooleanOptionalAction,
+        help="When summaries or images back up behind slow requests, skip to the newest and drop the rest. "
+        "Always off with --audio_file, where every interval gets its image",
+    )
+    parser.add_argument(
+        "--image_variants",
+        default=True,
+        action=argparse.BooleanOptionalAction,
+        help="Make WebP/JPEG copies of each image, at full size and phone size, for viewers to download instead of "
+        "the PNG, and show a tiny preview while they load",
+    )
     parser.add_argument("--server_host", default="0.0.0.0", help="Address to bind web server")
     parser.add_argument("--server_port", default=8080, type=int, help="Port to serve HTML viewer on")
+    parser.add_argument(
+        "--server_backend",
+        default="flask",
+        choices=["flask", "waitress"],
+        help="Web server for the viewer. waitress (pip install live_illustrate[server]) handles many viewers better",
+    )
+    parser.add_argument(
+        "--server_threads",
+        default=64,
+        type=int,
+        help="Worker threads for the waitress backend. Each open viewer holds one while it waits for new images",
+    )
+    parser.add_argument(
+        "--server_keepalive",
+        default=120,
+        type=int,
+        help="Seconds to hold an idle keep-alive connection open (waitress backend)",
+    )
+    parser.add_argument(
+        "--server_cached_images",
+        default=16,
+        type=int,
+        help="How many of the most recent images to keep in memory. Older ones are served from the session folder",
+    )
     parser.add_argument("--open", action="store_true", help="Automatically open a browser tab for the rendered images")
     parser.add_argument(
         "--persistence_of_memory",
@@ -96,17 +242,206 @@ def get_args() -> argparse.Namespace:
         type=float,
         help="How much of the previous transcription to retain after generating each summary. 0 - 1.0",
     )
+    parser.add_argument(
+        "--max_buffer_lines",
+        default=5000,
+        type=int,
+        help="Most lines of transcript to hold in memory, however high --persistence_of_memory is",
+    )
     parser.add_argument(
         "--oneshot",
         type=argparse.FileType("r"),
-        help="Read transcription lines from a text file and render. Useful for testing.",
+        help="Read transcription lines from a text file (or - for stdin) and render. Useful for testing.",
+    )
+    parser.add_argument(
+        "--audio_file",
+        help="Transcribe and illustrate a recording (or raw 16 kHz mono 16-bit PCM from stdin, with -) as fast as "
+        "possible instead of listening to the microphone. Exits once it's done",
+    )
+    parser.add_argument(
+        "--replay_wav",
+        help="Play back an audio file in place of the microphone, in real time. Useful for testing.",
+    )
+    parser.add_argument(
+        "--replay_speed", default=1.0, type=float, help="Play back --replay_wav this many times faster than real time"
+    )
+    parser.add_argument(
+        "--placeholder_url",
+        default="",
+        help="Download the image shown before the first render from here (e.g. https://placehold.co/{image_size}/png) "
+        "instead of showing a blank one. Fetched in the background, so the viewer doesn't wait on it",
+    )
+    parser.add_argument(
+        "--tables",
+        nargs="+",
+        metavar="NAME[=SOURCE]",
+        help="Illustrate several tables at once from one process, sharing the Whisper model, the OpenAI clients, and "
+        "the web server. SOURCE is a microphone's index or a recording to play back (at --replay_speed), and "
+        "defaults to the default microphone. Each table's viewer is at /t/NAME/ and its sessions are saved under "
+        "<data_dir>/NAME",
+    )
+    parser.add_argument(
+        "--table_max_backlog",
+        default=8,
+        type=int,
+        help="With --tables, drop a table's oldest phrases once this many are waiting to be transcribed, so a table "
+        "that's more than the shared model can keep up with stays current instead of falling further behind. "
+        "0 never drops any",
     )
     parser.add_argument("--data_dir", type=str, default=str(DEFAULT_DATA_DIR), help="Directory to save session data")
+    parser.add_argument(
+        "--resume",
+        metavar="SESSION_DIR",
+        help="Carry on with a session that was stopped or crashed (e.g. data/2024_05_01-19_00_00) from where it left "
+        "off: the transcript so far, the scene notes, and the images already shown, without summarizing or rendering "
+        "any of it again",
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="Reuse summaries and images for inputs that have been seen before (e.g. replaying a transcript with "
+        "--oneshot). Stored in <data_dir>/cache",
+    )
+    parser.add_argument(
+        "--cache_max_mb", default=1024, type=int, help="Evict least recently used cache entries past this size"
+    )
+    parser.add_argument(
+        "--discord_max_mb",
+        default=8.0,
+        type=float,
+        help="Images larger than this are re-encoded (and shrunk if need be) before uploading to Discord",
+    )
+    parser.add_argument(
+        "--discord_format",
+        default="png",
+        choices=["png", "jpeg", "webp"],
+        help="Format for images uploaded to Discord. PNGs that are too large are sent as JPEGs",
+    )
+    parser.add_argument(
+        "--metrics_json",
+        action="store_true",
+        help="Save pipeline metrics to metrics.json in the session folder on exit. They're always served at /metrics",
+    )
     parser.add_argument("-v", "--verbose", action="count", default=0)
-    return parser.parse_args()
+    args = parser.parse_args()
+    from .checkpoint import CHECKPOINT_FILE
+
+    if args.oneshot is not None and args.audio_file is not None:
+        parser.error("--oneshot and --audio_file are both ways to feed in a session; pick one")
+    if args.resume is not None and args.audio_file is not None:
+        parser.error("--resume can't be used with --audio_file, which starts the recording over from the beginning")
+    if args.resume is not None and not Path(args.resume).joinpath(CHECKPOINT_FILE).exists():
+        parser.error(f"{args.resume} has no {CHECKPOINT_FILE} to resume from")
+    if args.tables is not None:
+        if any(arg is not None for arg in (args.oneshot, args.audio_file, args.replay_wav, args.resume)):
+            parser.error("--tables can't be used with --oneshot, --audio_file, --replay_wav, or --resume")
+        try:
+            tables = [parse_table(spec) for spec in args.tables]
+        except ValueError as e:
+            parser.error(str(e))
+        args.tables = dict(tables)
+        if len(args.tables) < len(tables):
+            parser.error("each of the --tables needs a different name")
+    return args
+
+
+def make_server(args: argparse.Namespace, default_image: bytes, clock: SessionClock) -> "ImageServer":
+    from .serve import ImageServer
+
+    return ImageServer(
+        host=args.server_host,
+        port=args.server_port,
+        default_image=default_image,
+        backend=args.server_backend,
+        threads=args.server_threads,
+        keepalive=args.server_keepalive,
+        max_cached_images=args.server_cached_images,
+        clock=clock,
+    )
+
+
+def make_engine(args: argparse.Namespace) -> "WhisperEngine | WhisperPool":
+    """Loads in the background; transcription waits for it the first time through"""
+    from .whisper_engine import WhisperEngine, WhisperPool
+
+    if args.transcribe_workers > 1:
+        return WhisperPool(
+            workers=args.transcribe_workers,
+            model=args.audio_model,
+            compute_type=args.audio_compute_type,
+            batch_size=args.audio_batch_size,
+            background=True,
+        )
+    return WhisperEngine(
+        model=args.audio_model,
+        compute_type=args.audio_compute_type,
+        batch_size=args.audio_batch_size,
+        background=True,
+    )
+
+
+def make_text_buffer(args: argparse.Namespace, clock: SessionClock) -> "TextBuffer":
+    from .text_buffer import TextBuffer
+
+    return TextBuffer(
+        wait_minutes=args.wait_minutes,
+        max_context=args.max_context,
+        persistence=args.persistence_of_memory,
+        lead_seconds=args.summary_lead_seconds,
+        clock=clock,
+        max_lines=args.max_buffer_lines,
+        rolling=args.rolling_summary,
+        min_wait_minutes=args.min_wait_minutes,
+        trigger_tokens=args.trigger_tokens,
+        min_new_tokens=args.min_new_tokens,
+        max_similarity=args.max_similarity,
+    )
+
+
+def make_backend(args: argparse.Namespace, timer: StartupTimer) -> "AsyncOpenAIBackend | None":
+    """The async backend, if it's wanted. Either way, the OpenAI client (and the tokenizer) load in the background."""
+    from .openai_backend import AsyncOpenAIBackend, sync_client
+    from .util import get_encoding
+
+    backend = (
+        AsyncOpenAIBackend(concurrency=args.openai_concurrency, timeout=args.openai_timeout)
+        if args.openai_backend == "async"
+        else None
+    )
+    # nothing gets summarized or rendered without a client, e.g. if OPENAI_API_KEY isn't set
+    timer.background("openai", backend.wait_until_ready if backend is not None else sync_client, required=True)
+    timer.background("tokenizer", get_encoding)
+    return backend
+
+
+def make_summarizer(
+    args: argparse.Namespace, cache: DiskCache | None, backend: "AsyncOpenAIBackend | None"
+) -> "TextSummarizer":
+    from .summarize import TextSummarizer
+
+    return TextSummarizer(model=args.summarize_model, cache=cache, backend=backend)
+
+
+def make_renderer(
+    args: argparse.Namespace, cache: DiskCache | None, backend: "AsyncOpenAIBackend | None"
+) -> "ImageRenderer":
+    from .render import ImageRenderer
+
+    return ImageRenderer(
+        model=args.image_model,
+        image_size=args.image_size,
+        image_quality=args.image_quality,
+        image_style=args.image_style,
+        cache=cache,
+        candidates=args.image_candidates,
+        candidate_styles=args.candidate_styles,
+        backend=backend,
+    )
 
 
 def main() -> None:
+    # Everything slow (the Whisper model, openai, the tokenizer) loads in the background while the viewer is up
+    timer = StartupTimer()
     args = get_args()
     logging.basicConfig(format="%(name)s: %(message)s", level=logging.DEBUG if args.verbose > 0 else logging.INFO)
 
@@ -116,76 +451,253 @@ def main() -> None:
     logging.getLogger("werkzeug").setLevel(logging.INFO if args.verbose > 0 else logging.WARNING)  # flask
     logging.getLogger("faster_whisper").setLevel(logging.INFO if args.verbose > 0 else logging.WARNING)  # flask
 
+    from .audio_sources import AudioFileSource, WavSource
+    from .checkpoint import load_checkpoint, session_elapsed, unrendered_summary
+    from .imaging import ImageProcessor, blank_image
+    from .session_data import SessionData
+    from .tables import Table
+    from .transcribe import AudioTranscriber
+    from .util import Transcription, download_image
+
+    timer.mark("imports")
+    if args.tables is not None:
+        run_tables(args, timer)
+        return
+
+    # A recording is processed faster than real time, so the session's clock follows the audio instead
+    is_recording = args.audio_file is not None
+    clock = AudioClock() if is_recording else SessionClock()
+    if is_recording and args.stream_seconds > 0:
+        logging.getLogger("AudioTranscriber").warning("--stream_seconds is ignored with --audio_file")
+        args.stream_seconds = 0
+
+    # Resuming has to be quick, since the table is waiting. The checkpoint has everything, token counts included.
+    data_dir = Path(args.resume if args.resume is not None else args.data_dir)
+    records = load_checkpoint(data_dir) if args.resume is not None else []
+    if records:
+        clock.resume_from(session_elapsed(records))
+
+    server = make_server(args, blank_image(args.image_size), clock)
+    for record in records:
+        if record["k"] == "image":
+            server.restore_image(data_dir.joinpath(record["path"]), record["etag"])
+    server_thread = Thread(target=server.start, daemon=True)
+    server_thread.start()
+    timer.wait_for_server(args.server_host, args.server_port, server_thread)
+    if args.placeholder_url:
+
+        def fetch_placeholder() -> None:
+            url = args.placeholder_url.format(image_size=args.image_size)
+            if image_bytes := download_image(url, timeout=PLACEHOLDER_TIMEOUT):
+                server.update_placeholder(image_bytes)
+
+        timer.background("placeholder", fetch_placeholder)
+
     # We don't test transcription in oneshot mode
     if not (is_oneshot := args.oneshot is not None):
+        engine = make_engine(args)
+        # the microphone is listening in the meantime; phrases just queue up until the model is ready
+        timer.background("whisper", engine.wait_until_loaded)
         transcriber = AudioTranscriber(
-            model=args.audio_model,
+            engine=engine,
             phrase_timeout=args.wait_minutes * args.phrase_timeout,
-            compute_type=args.audio_compute_type,
+            batch_size=args.audio_batch_size,
+            stream_seconds=args.stream_seconds,
+            source=(
+                AudioFileSource(args.audio_file)
+                if is_recording
+                else WavSource(args.replay_wav, speed=args.replay_speed) if args.replay_wav else None
+            ),
+            clock=clock,
         )
 
     # Create each of our thread objects with the apppropriate command line args
-    buffer = TextBuffer(
-        wait_minutes=args.wait_minutes, max_context=args.max_context, persistence=args.persistence_of_memory
+    buffer = make_text_buffer(args, clock)
+    if records:
+        buffer.restore(records)
+        timer.mark("resume")
+        buffer.logger.info(
+            "Resuming %s at %s in, with %d lines of transcript and %d images",
+            data_dir,
+            timedelta(seconds=int(clock.elapsed())),
+            buffer.lines_added,
+            server.latest_id,
+        )
+    cache = DiskCache(Path(args.data_dir).joinpath("cache"), args.cache_max_mb * 1_000_000) if args.cache else None
+    backend = make_backend(args, timer)
+    summarizer, renderer = make_summarizer(args, cache, backend), make_renderer(args, cache, backend)
+    # a recording is processed faster than real time, so summaries pile up by design rather than going stale
+    summarizer.coalesce = renderer.coalesce = args.coalesce and not is_recording
+    processor = ImageProcessor() if args.image_variants else None
+    if (summary := unrendered_summary(records)) is not None:
+        renderer.logger.info("Rendering the last summary, which didn't get its image before the session stopped")
+        renderer.send(summary)
+
+    table = Table(
+        "",
+        transcriber=None if is_oneshot else transcriber,
+        buffer=buffer,
+        summarizer=summarizer,
+        renderer=renderer,
+        server=server,
+        session_data=SessionData(
+            data_dir,
+            echo=True,
+            discord_max_bytes=int(args.discord_max_mb * 1_000_000),
+            discord_format=args.discord_format,
+            dump_metrics=args.metrics_json,
+            clock=clock,
+            resume=args.resume is not None,
+        ),
+        processor=processor,
     )
-    summarizer = TextSummarizer(model=args.summarize_model)
-    renderer = ImageRenderer(
-        model=args.image_model,
-        image_size=args.image_size,
-        image_quality=args.image_quality,
-        image_style=args.image_style,
+
+    def until_done() -> None:
+        if is_oneshot:
+            # Read all the lines from the file, pretend we transcribed them. Lines piped in over stdin can trickle
+            # in while the server runs. This will still dump things in the data directory, since the point is to
+            # test everything downstream of transcription.
+            for line in args.oneshot:  # type: ignore
+                table.on_text_transcribed(Transcription(line.strip(), timestamp=time()))
+        if is_recording:
+            # The images are still served while a recording is processed, but we're done when it is
+            table.finish()
+            if processor is not None:
+                processor.stop()
+            table.session_data.logger.info("Finished %s, see %s", args.audio_file, table.session_data.data_dir)
+        else:
+            server_thread.join()  # until ctrl+c, or the server fails to start
+
+    run_pipeline(
+        args,
+        timer,
+        {table.name: table},
+        processor,
+        until_done,
+        engine=None if is_oneshot else engine,
+        backend=backend,
+        cache=cache,
     )
-    server = ImageServer(
-        host=args.server_host,
-        port=args.server_port,
-        default_image=b64encode(download_image(f"https://placehold.co/{args.image_size}/png")).decode("utf-8"),
-    )
-
-    with SessionData(Path(args.data_dir), echo=True) as session_data:
-        # wire up some callbacks to save the intermediate data and forward it along
-        def on_text_transcribed(transcription: Transcription) -> None:
-            if is_transcription_interesting(transcription):
-                session_data.save_transcription(transcription)
-                buffer.send(transcription)
-
-        def on_summary_generated(summary: Summary | None) -> None:
-            if summary:
-                session_data.save_summary(summary)
-                renderer.send(summary)
-
-        def on_image_rendered(image: Image | None) -> None:
-            if image:
-                server.update_image(image)
-                session_data.save_image(image)
-
-        # start each thread with the appropriate callback
-        if not is_oneshot:
-            Thread(target=transcriber.start, args=(on_text_transcribed,), daemon=True).start()
-        Thread(target=summarizer.start, args=(on_summary_generated,), daemon=True).start()
-        Thread(target=renderer.start, args=(on_image_rendered,), daemon=True).start()
-
-        # Buffer has two threads running at once - one to just pull text from the queue and
-        # append it to the buffer, and one to wake up every few minutes and grab the context
-        # for summarizing.
-        Thread(target=buffer.start, args=(lambda _len: None,), daemon=True).start()
-        Thread(target=buffer.buffer_forever, args=(summarizer.send,), daemon=True).start()
 
+
+def run_pipeline(
+    args: argparse.Namespace,
+    timer: StartupTimer,
+    tables: t.Dict[str, "Table"],
+    processor: "ImageProcessor | None",
+    until_done: t.Callable[[], t.Any],
+    engine: "WhisperEngine | WhisperPool | None",
+    backend: "AsyncOpenAIBackend | None",
+    cache: DiskCache | None,
+) -> None:
+    """Starts every table and runs until `until_done` returns (or ctrl+c), then shuts everything down"""
+    from .util import Image
+    from .whisper_engine import WhisperPool
+
+    if args.rolling_summary and args.summary_lead_seconds > 0:
+        logging.getLogger("TextBuffer").warning("--summary_lead_seconds is ignored with --rolling_summary")
+
+    def on_image_processed(processed: t.Tuple[Image, Path, str]) -> None:
+        image, path, name = processed
+        tables[name].server.update_image(image, path)
+
+    with ExitStack() as session_folders:
+        for table in tables.values():
+            session_folders.enter_context(table.session_data)
+            table.start()
+        if processor is not None:
+            Thread(target=processor.start, args=(on_image_processed,), daemon=True).start()
         if args.open:
-            # opening the browser tab automatically doesn't seem to work through WSL
-            def open_browser() -> None:
-                sleep(2)
-                open_new_tab(f"http://{args.server_host}:{args.server_port}")
+            open_new_tab(f"http://{args.server_host}:{args.server_port}")
 
-            Thread(target=lambda: open_browser).start()
+        timer.mark("pipeline")
+        timer.report()
 
-        if is_oneshot:
-            # Read all the lines from the file, pretend we transcribed them
-            for line in args.oneshot:  # type: ignore
-                # This will still dump things in the data directory. No sense short circuiting the testing.
-                on_text_transcribed(Transcription(line.strip()))
+        try:
+            until_done()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for table in tables.values():
+                table.stop(timeout=SHUTDOWN_TIMEOUT)
+            if processor is not None and not processor.stop(timeout=SHUTDOWN_TIMEOUT):
+                processor.logger.warning("Still busy after %ss, giving up on remaining work", SHUTDOWN_TIMEOUT)
+            if isinstance(engine, WhisperPool):
+                engine.shutdown()
+            if backend is not None:
+                backend.close()
+            if cache is not None:
+                cache.logger.info(cache.stats)
+            logging.getLogger("live_illustrate").info(metrics.memory_report())
+    if timer.failed:
+        sys.exit(1)
+
+
+def run_tables(args: argparse.Namespace, timer: StartupTimer) -> None:
+    """--tables: a pipeline for each table, all sharing the Whisper model, the OpenAI clients, image processing, and
+    one web server"""
+    from .imaging import ImageProcessor, blank_image
+    from .serve import MultiTableServer
+    from .session_data import SessionData
+    from .tables import Table, audio_source
+    from .transcribe import AudioTranscriber
+    from .whisper_engine import FairScheduler
+
+    default_image = blank_image(args.image_size)
+    clocks = {name: SessionClock() for name in args.tables}
+    servers = {name: make_server(args, default_image, clocks[name]) for name in args.tables}
+    server = MultiTableServer(
+        servers,
+        host=args.server_host,
+        port=args.server_port,
+        backend=args.server_backend,
+        threads=args.server_threads,
+        keepalive=args.server_keepalive,
+    )
+    server_thread = Thread(target=server.start, daemon=True)
+    server_thread.start()
+    timer.wait_for_server(args.server_host, args.server_port, server_thread)
+
+    engine = make_engine(args)
+    timer.background("whisper", engine.wait_until_loaded)
+    # a pool can decode a phrase from each of several tables at once
+    scheduler = FairScheduler(engine, concurrency=args.transcribe_workers)
+    cache = DiskCache(Path(args.data_dir).joinpath("cache"), args.cache_max_mb * 1_000_000) if args.cache else None
+    backend = make_backend(args, timer)
+    processor = ImageProcessor() if args.image_variants else None
+
+    tables: t.Dict[str, "Table"] = {}
+    for name, source in args.tables.items():
+        clock = clocks[name]
+        summarizer, renderer = make_summarizer(args, cache, backend), make_renderer(args, cache, backend)
+        summarizer.coalesce = renderer.coalesce = args.coalesce
+        tables[name] = Table(
+            name,
+            transcriber=AudioTranscriber(
+                engine=scheduler.for_table(name),
+                phrase_timeout=args.wait_minutes * args.phrase_timeout,
+                batch_size=args.audio_batch_size,
+                stream_seconds=args.stream_seconds,
+                source=audio_source(source, args.replay_speed),
+                clock=clock,
+                max_backlog=args.table_max_backlog,
+            ),
+            buffer=make_text_buffer(args, clock),
+            summarizer=summarizer,
+            renderer=renderer,
+            server=servers[name],
+            session_data=SessionData(
+                Path(args.data_dir).joinpath(name),
+                echo=False,  # the tables' transcripts would be all mixed up
+                discord_max_bytes=int(args.discord_max_mb * 1_000_000),
+                discord_format=args.discord_format,
+                dump_metrics=args.metrics_json,
+                clock=clock,
+            ),
+            processor=processor,
+        )
 
-        # flask feels like it probably has a good ctrl+c handler, so we'll make this one the main thread
-        server.start()
+    run_pipeline(args, timer, tables, processor, server_thread.join, engine=engine, backend=backend, cache=cache)
 
 
 if __name__ == "__main__":
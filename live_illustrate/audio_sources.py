@@ -0,0 +1,143 @@
+import sys
+import typing as t
+from time import monotonic, sleep
+
+import numpy as np
+import soundfile as sf  # type: ignore
+import speech_recognition as sr  # type: ignore
+
+from .whisper_engine import (
+    MAX_CHUNK_SECONDS,
+    MIN_SILENCE_MS,
+    SAMPLE_RATE,
+    audio_to_array,
+)
+
+READ_SECONDS = 10  # how much of the recording to read at a time
+
+
+class WavSource(sr.AudioSource):
+    """Stands in for sr.Microphone, playing back a recording at (a multiple of) real time. Once the recording
+    runs out it keeps producing silence, like a quiet room. Lets the live pipeline be run and benchmarked
+    without a microphone."""
+
+    def __init__(self, path: str, speed: float = 1.0, chunk_size: int = 1024) -> None:
+        self.path: str = path
+        self.speed: float = speed
+        self.SAMPLE_RATE: int = SAMPLE_RATE
+        self.SAMPLE_WIDTH: int = 2
+        self.CHUNK: int = chunk_size
+        self.stream: _PacedStream | None = None
+
+    def __enter__(self) -> "WavSource":
+        if self.stream is None:
+            self.stream = _PacedStream(load_pcm(self.path), self.speed)
+        return self
+
+    def __exit__(self, *exc) -> None:
+        # listen_in_background re-enters the source for every phrase, so playback carries on between them
+        pass
+
+
+class _PacedStream:
+    def __init__(self, pcm: bytes, speed: float) -> None:
+        self.pcm: bytes = pcm
+        self.speed: float = speed
+        self.position: int = 0
+        self.started: float | None = None
+
+    def read(self, frames: int) -> bytes:
+        """Returns the next `frames` samples, waiting until they'd have been spoken"""
+        if self.started is None:
+            self.started = monotonic()
+        size = frames * 2
+        chunk = self.pcm[self.position : self.position + size]
+        self.position += size
+        if len(chunk) < size:
+            chunk += bytes(size - len(chunk))
+        due = self.started + self.position / 2 / SAMPLE_RATE / self.speed
+        if (delay := due - monotonic()) > 0:
+            sleep(delay)
+        return chunk
+
+    def close(self) -> None:
+        pass
+
+
+class AudioFileSource(sr.AudioSource):
+    """A recording to transcribe as fast as Whisper can go, instead of listening to the microphone. Anything
+    soundfile can read works, or "-" for raw 16 kHz mono 16-bit PCM on stdin. The audio is cut into phrases
+    of up to MAX_CHUNK_SECONDS at pauses found by the VAD, and stretches with no speech are skipped."""
+
+    def __init__(self, path: str) -> None:
+        self.path: str = path
+        self.seconds_read: float = 0.0
+
+    def __enter__(self) -> "AudioFileSource":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        pass
+
+    def phrases(self) -> t.Iterator[t.Tuple[float, np.ndarray]]:
+        """(offset in seconds of the end of the phrase, 16 kHz mono float32 audio) for each phrase, in order"""
+        # slow to import, so not until it's needed
+        from faster_whisper.vad import VadOptions  # type: ignore
+
+        vad_options = VadOptions(min_silence_duration_ms=MIN_SILENCE_MS)
+        window = MAX_CHUNK_SECONDS * SAMPLE_RATE
+        pending = np.zeros(0, dtype=np.float32)
+        offset = 0  # samples before the start of pending
+        for block in self._blocks():
+            pending = np.concatenate([pending, block])
+            while len(pending) >= window:
+                cut, has_speech = self._cut(pending[:window], vad_options)
+                if has_speech:
+                    yield (offset + cut) / SAMPLE_RATE, pending[:cut]
+                offset += cut
+                pending = pending[cut:]
+        if len(pending) and self._cut(pending, vad_options)[1]:
+            yield (offset + len(pending)) / SAMPLE_RATE, pending
+
+    def _cut(self, audio: np.ndarray, vad_options: t.Any) -> t.Tuple[int, bool]:
+        """Where to end the phrase at the start of `audio`, and whether there's any speech before that.
+        Cuts in the middle of the last pause, unless the audio already ends in silence."""
+        from faster_whisper.vad import get_speech_timestamps  # type: ignore
+
+        speech = get_speech_timestamps(audio, vad_options, sampling_rate=SAMPLE_RATE)
+        if not speech:
+            return len(audio), False
+        min_silence = MIN_SILENCE_MS * SAMPLE_RATE // 1000
+        if speech[-1]["end"] < len(audio) - min_silence or len(speech) == 1:
+            return len(audio), True
+        return (speech[-2]["end"] + speech[-1]["start"]) // 2, True
+
+    def _blocks(self) -> t.Iterator[np.ndarray]:
+        if self.path == "-":
+            leftover = b""  # a pipe can hand over half a sample, so keep it for the next read
+            while chunk := sys.stdin.buffer.read(READ_SECONDS * SAMPLE_RATE * 2):
+                self.seconds_read += len(chunk) / 2 / SAMPLE_RATE
+                chunk, leftover = leftover + chunk, b""
+                if len(chunk) % 2:
+                    chunk, leftover = chunk[:-1], chunk[-1:]
+                yield audio_to_array(chunk)
+            return
+        info = sf.info(self.path)
+        for block in sf.blocks(self.path, blocksize=READ_SECONDS * info.samplerate, dtype="float32", always_2d=True):
+            self.seconds_read += len(block) / info.samplerate
+            yield resample(block.mean(axis=1), info.samplerate)
+
+
+def resample(audio: np.ndarray, rate: int) -> np.ndarray:
+    """Converts mono float audio to 16 kHz. Linear interpolation is plenty for speech recognition."""
+    if rate == SAMPLE_RATE:
+        return audio.astype(np.float32)
+    positions = np.arange(0, len(audio), rate / SAMPLE_RATE)
+    return np.interp(positions, np.arange(len(audio)), audio).astype(np.float32)
+
+
+def load_pcm(path: str) -> bytes:
+    """Reads an audio file as 16 kHz mono 16-bit PCM, which is what Whisper wants"""
+    audio, rate = sf.read(path, dtype="float32", always_2d=True)
+    mono = resample(audio.mean(axis=1), rate)
+    return t.cast(bytes, (np.clip(mono, -1.0, 1.0) * 32767).astype(np.int16).tobytes())
@@ -0,0 +1,86 @@
+import hashlib
+import logging
+import os
+import typing as t
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock
+
+
+class DiskCache:
+    """Content-addressed store for API results, so that replaying a transcript doesn't pay for (or wait on)
+    the same completions and images again. Once the cache grows past max_bytes, the least recently used
+    entries are evicted."""
+
+    def __init__(self, directory: Path, max_bytes: int) -> None:
+        self.logger = logging.getLogger("DiskCache")
+        self.directory: Path = directory
+        self.max_bytes: int = max_bytes
+        self.hits: int = 0
+        self.misses: int = 0
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock = Lock()
+        # key -> size, least recently used first. File modification times carry the order across runs.
+        self._entries: t.OrderedDict[str, int] = OrderedDict(
+            (path.name, stat.st_size)
+            for path, stat in sorted(
+                ((path, path.stat()) for path in self.directory.iterdir() if path.is_file() and not path.suffix),
+                key=lambda entry: entry[1].st_mtime,
+            )
+        )
+        self._size: int = sum(self._entries.values())
+        self.logger.info("%d entries (%.1f MB) in %s", len(self._entries), self._size / 1e6, self.directory)
+
+    @staticmethod
+    def key(*parts: str | bytes) -> str:
+        """Hash of everything that affects the result. Parts are length-prefixed so they can't run together."""
+        digest = hashlib.sha256()
+        for part in parts:
+            data = part.encode("utf-8") if isinstance(part, str) else part
+            digest.update(len(data).to_bytes(8, "little"))
+            digest.update(data)
+        return digest.hexdigest()
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            path = self.directory.joinpath(key)
+            try:
+                data = path.read_bytes()
+                os.utime(path)  # mark as recently used for the next run
+            except OSError as e:
+                self.logger.warning("Dropping unreadable entry %s: %s", key, e)
+                self._size -= self._entries.pop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key: str, value: bytes) -> None:
+        with self._lock:
+            path = self.directory.joinpath(key)
+            tmp = path.with_suffix(".tmp")
+            try:
+                tmp.write_bytes(value)
+                os.replace(tmp, path)  # so a crash can't leave a truncated entry behind
+            except OSError as e:
+                self.logger.warning("Failed to cache %s: %s", key, e)
+                return
+            self._size += len(value) - self._entries.pop(key, 0)
+            self._entries[key] = len(value)
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                evicted, size = self._entries.popitem(last=False)
+                self.directory.joinpath(evicted).unlink(missing_ok=True)
+                self._size -= size
+
+    @property
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        return (
+            f"{self.hits} hits, {self.misses} misses ({self.hits / total if total else 0:.0%} hit rate), "
+            f"{len(self._entries)} entries, {self._size / 1e6:.1f} MB"
+        )
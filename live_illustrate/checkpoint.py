@@ -0,0 +1,45 @@
+import json
+import logging
+import typing as t
+from pathlib import Path
+
+from .util import Summary
+
+CHECKPOINT_FILE = "checkpoint.jsonl"
+
+# One JSON object per line, appended as the session goes, so a crash loses at most the last few. Every record has
+# "k" (its kind) and "e" (seconds into the session). The kinds, and what else they carry:
+#   line        a transcript line as it went into the TextBuffer: "text", "tokens"
+#   summarized  the buffer's context was handed off to be summarized: "lines", "tokens" (running totals)
+#   trim        the buffer let go of old lines: "first" (the number of the first line it kept)
+#   scene       rolling summary notes: "scene", "through" (the line they cover up to)
+#   summary     a finished summary: "summary", "scene"
+#   image       a rendered image: "path" (relative to the session folder), "etag"
+Record = t.Dict[str, t.Any]
+
+
+def load_checkpoint(session_dir: Path) -> t.List[Record]:
+    """Reads back a session's checkpoint. A line cut short by a crash is ignored."""
+    records: t.List[Record] = []
+    with open(session_dir.joinpath(CHECKPOINT_FILE)) as checkpointf:
+        for number, line in enumerate(checkpointf, start=1):
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                logging.getLogger("Checkpoint").warning("Ignoring unreadable line %d of the checkpoint", number)
+    return records
+
+
+def session_elapsed(records: t.List[Record]) -> float:
+    """How far into the session the last checkpoint was written"""
+    return max((record["e"] for record in records), default=0.0)
+
+
+def unrendered_summary(records: t.List[Record]) -> Summary | None:
+    """The last summary, if the session ended before its image was rendered"""
+    for record in reversed(records):
+        if record["k"] == "image":
+            return None
+        if record["k"] == "summary":
+            return Summary("", record["summary"], scene=record.get("scene"))
+    return None
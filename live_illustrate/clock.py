@@ -0,0 +1,60 @@
+from threading import Condition, Event
+from time import time
+
+
+class SessionClock:
+    """Time as the session experiences it. Normally that's just the wall clock."""
+
+    def __init__(self) -> None:
+        self.start: float = time()
+
+    def now(self) -> float:
+        return time()
+
+    def elapsed(self) -> float:
+        return self.now() - self.start
+
+    def elapsed_at(self, timestamp: float | None) -> float:
+        """How far into the session something with this timestamp happened. Live, that's just now."""
+        return self.elapsed()
+
+    def advance_to(self, timestamp: float) -> None:
+        """Called with the timestamp of each transcribed line. The wall clock moves on by itself."""
+
+    def resume_from(self, elapsed: float) -> None:
+        """Picks the session back up this far in, however long ago that was"""
+        self.start = self.now() - elapsed
+
+    def wait_until(self, deadline: float, stop_event: Event) -> bool:
+        """Sleeps until now() reaches the deadline. Returns True if stop_event was set first."""
+        return stop_event.wait(timeout=max(0.0, deadline - self.now()))
+
+
+class AudioClock(SessionClock):
+    """Session time that advances with the audio that has been transcribed, rather than the wall clock, so a
+    recording processed faster than real time gets the same summary intervals and timestamps it would have live"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._now: float = self.start
+        self._advanced = Condition()
+
+    def now(self) -> float:
+        return self._now
+
+    def elapsed_at(self, timestamp: float | None) -> float:
+        # transcription runs ahead of summarizing and rendering, so go by the audio the item came from
+        return self.elapsed() if timestamp is None else max(0.0, timestamp - self.start)
+
+    def advance_to(self, timestamp: float) -> None:
+        with self._advanced:
+            if timestamp > self._now:
+                self._now = timestamp
+                self._advanced.notify_all()
+
+    def wait_until(self, deadline: float, stop_event: Event) -> bool:
+        with self._advanced:
+            # wake up every so often to check stop_event, since setting it doesn't notify us
+            while self._now < deadline and not stop_event.is_set():
+                self._advanced.wait(timeout=0.5)
+        return stop_event.is_set()
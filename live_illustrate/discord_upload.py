@@ -0,0 +1,88 @@
+import json
+import random
+from time import sleep
+
+import requests
+
+from .imaging import MIME_TYPES, fit_image
+from .util import AsyncThread, Image
+
+MAX_ATTEMPTS = 5
+BACKOFF_SECONDS = 2.0  # doubled after each failed attempt, plus some jitter
+TIMEOUT_SECONDS = 30.0
+DESCRIPTION_LIMIT = 1024
+
+
+class DiscordUploader(AsyncThread):
+    """Posts rendered images to a Discord webhook from its own thread, so a slow upload never holds up the
+    rest of the pipeline. Keeps one HTTP session open, honors Discord's rate limits, and retries failures with
+    backoff. Works with anything that speaks the webhook API, such as a local stand-in for testing."""
+
+    def __init__(self, webhook_url: str, max_bytes: int = 8_000_000, image_format: str = "png") -> None:
+        super().__init__("DiscordUploader")
+        self.webhook_url: str = webhook_url
+        self.max_bytes: int = max_bytes
+        self.image_format: str = image_format
+        self.session = requests.Session()
+
+    def work(self, image: Image, name: str) -> bool:
+        """Uploads the image, re-encoded to fit under max_bytes if needed. Returns whether it went through."""
+        data, image_format = fit_image(image.image_bytes, self.max_bytes, self.image_format)
+        if len(data) != len(image.image_bytes):
+            self.logger.info(
+                "Re-encoded %s as %s (%d -> %d bytes)", name, image_format, len(image.image_bytes), len(data)
+            )
+        filename = f"{name}.{image_format}"
+        payload = {
+            "attachments": [{"id": 0, "filename": filename, "description": image.summary[: DESCRIPTION_LIMIT - 1]}]
+        }
+
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                response = self.session.post(
+                    self.webhook_url,
+                    params={"wait": "true"},
+                    data={"payload_json": json.dumps(payload)},
+                    files={"files[0]": (filename, data, MIME_TYPES[image_format])},
+                    timeout=TIMEOUT_SECONDS,
+                )
+            except requests.RequestException as e:
+                delay = self._backoff(attempt)
+                self.logger.warning("Upload failed (%s), retrying in %.1fs", e, delay)
+            else:
+                if response.ok:
+                    self._respect_bucket(response)
+                    return True
+                if response.status_code == 429:
+                    delay = self._retry_after(response)
+                    self.logger.warning("Rate limited by Discord, retrying in %.1fs", delay)
+                elif response.status_code >= 500:
+                    delay = self._backoff(attempt)
+                    self.logger.warning("Discord returned %d, retrying in %.1fs", response.status_code, delay)
+                else:
+                    self.logger.error("failed to send image to discord: %d %s", response.status_code, response.text)
+                    return False
+            sleep(delay)
+        self.logger.error("failed to send image to discord after %d attempts", MAX_ATTEMPTS)
+        return False
+
+    def _respect_bucket(self, response: requests.Response) -> None:
+        """If that used up the rate limit bucket, wait for it to refill before the next upload"""
+        if response.headers.get("X-RateLimit-Remaining") == "0":
+            sleep(float(response.headers.get("X-RateLimit-Reset-After", 1.0)))
+
+    @staticmethod
+    def _retry_after(response: requests.Response) -> float:
+        try:
+            return float(response.json()["retry_after"])
+        except (ValueError, KeyError, TypeError):
+            return float(response.headers.get("Retry-After", BACKOFF_SECONDS))
+
+    @staticmethod
+    def _backoff(attempt: int) -> float:
+        return BACKOFF_SECONDS * 2**attempt * random.uniform(0.75, 1.25)
+
+    def stop(self, drain: bool = True, timeout: float | None = None) -> bool:
+        stopped = super().stop(drain, timeout)
+        self.session.close()
+        return stopped
@@ -0,0 +1,103 @@
+import typing as t
+from base64 import b64encode
+from io import BytesIO
+
+from PIL import Image as PILImage
+
+from .util import AsyncThread, Image
+
+MIME_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+QUALITY_STEPS = [90, 80, 70, 60]
+SCALE_STEP = 0.75  # how much to shrink each side by when even the lowest quality doesn't fit
+
+# Variants made for viewers, by size (width in pixels, None for full size) and format. The original PNG is kept too.
+VARIANT_WIDTHS: t.Dict[str, int | None] = {"full": None, "small": 768}
+VARIANT_FORMATS = ("webp", "jpeg")
+VARIANT_QUALITY = 80
+PLACEHOLDER_WIDTH = 32  # inlined into the page so there's something to show while the real image loads
+BLANK_COLOR = (24, 24, 24)
+
+
+def encode_image(image_bytes: bytes, image_format: str, quality: int = 85, scale: float = 1.0) -> bytes:
+    """Re-encodes an image (usually the PNG we got from OpenAI) as png, jpeg, or webp, optionally shrunk"""
+    with PILImage.open(BytesIO(image_bytes)) as original:
+        image: PILImage.Image = original
+        if scale < 1.0:
+            image = image.resize((max(1, int(image.width * scale)), max(1, int(image.height * scale))))
+        if image_format == "jpeg" and image.mode != "RGB":
+            image = image.convert("RGB")
+        out = BytesIO()
+        image.save(out, format=image_format.upper(), quality=quality, optimize=True)
+        return out.getvalue()
+
+
+def fit_image(image_bytes: bytes, max_bytes: int, image_format: str = "png") -> t.Tuple[bytes, str]:
+    """Returns the image (and its format) re-encoded to fit under max_bytes. PNGs are left alone if they already fit,
+    and otherwise become JPEGs. Quality is lowered first, then the image is scaled down until it fits."""
+    if image_format == "png":
+        if len(image_bytes) <= max_bytes:
+            return image_bytes, "png"
+        image_format = "jpeg"
+
+    scale = 1.0
+    while True:
+        for quality in QUALITY_STEPS:
+            encoded = encode_image(image_bytes, image_format, quality=quality, scale=scale)
+            if len(encoded) <= max_bytes:
+                return encoded, image_format
+        scale *= SCALE_STEP
+        if scale < 0.05:
+            return encoded, image_format  # give up; let the upload fail with a useful error
+
+
+def blank_image(size: str) -> bytes:
+    """A plain PNG of the given "<width>x<height>", to show before the first image is rendered"""
+    width, height = (int(side) for side in size.split("x"))
+    out = BytesIO()
+    PILImage.new("RGB", (width, height), BLANK_COLOR).save(out, format="PNG", optimize=True)
+    return out.getvalue()
+
+
+def make_variants(image_bytes: bytes, quality: int = VARIANT_QUALITY) -> t.Dict[str, bytes]:
+    """Compressed copies of an image for viewers, keyed like "small.webp", plus a tiny "placeholder.jpeg".
+    Sizes that would be no smaller than the original are skipped."""
+    variants: t.Dict[str, bytes] = {}
+    with PILImage.open(BytesIO(image_bytes)) as original:
+        rgb = original.convert("RGB")  # neither the placeholder nor the jpegs have an alpha channel
+        for size, width in list(VARIANT_WIDTHS.items()) + [("placeholder", PLACEHOLDER_WIDTH)]:
+            if width is not None and width >= rgb.width:
+                continue
+            resized = rgb if width is None else rgb.resize((width, max(1, rgb.height * width // rgb.width)))
+            for image_format in VARIANT_FORMATS if size != "placeholder" else ("jpeg",):
+                out = BytesIO()
+                resized.save(out, format=image_format.upper(), quality=quality, optimize=True)
+                variants[f"{size}.{image_format}"] = out.getvalue()
+    return variants
+
+
+def data_uri(image_bytes: bytes, image_format: str = "jpeg") -> str:
+    return f"data:{MIME_TYPES[image_format]};base64,{b64encode(image_bytes).decode('ascii')}"
+
+
+class ImageProcessor(AsyncThread):
+    """Makes the compressed and downsized variants of each rendered image that the server hands to viewers,
+    on its own thread so encoding never holds up the renderer"""
+
+    def __init__(self, quality: int = VARIANT_QUALITY) -> None:
+        super().__init__("ImageProcessor")
+        self.quality: int = quality
+
+    def work(self, image: Image, *passthrough: t.Any) -> t.Tuple[t.Any, ...]:
+        """Fills in image.variants. Anything else sent along with the image is passed through to the callback."""
+        try:
+            image.variants = make_variants(image.image_bytes, self.quality)
+        except Exception as e:
+            # viewers can always fall back on the original
+            self.logger.error("failed to make image variants: %s", e)
+        self.logger.debug(
+            "Made %d variants of a %d byte image: %s",
+            len(image.variants),
+            len(image.image_bytes),
+            ", ".join(f"{name} {len(data)}" for name, data in image.variants.items()),
+        )
+        return (image, *passthrough)
@@ -0,0 +1,182 @@
+import json
+import os
+import typing as t
+from bisect import bisect_left
+from pathlib import Path
+from threading import Lock
+
+PREFIX = "live_illustrate"
+
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+TOKEN_BUCKETS = (10, 50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000)
+RATIO_BUCKETS = (0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 4.0)
+
+# name -> (type, help, histogram buckets)
+DEFINITIONS: t.Dict[str, t.Tuple[str, str, t.Sequence[float]]] = {
+    "stage_queue_depth": ("gauge", "Items waiting in a stage's queue", ()),
+    "stage_wait_seconds": ("histogram", "Time items spent queued before a stage picked them up", LATENCY_BUCKETS),
+    "stage_work_seconds": ("histogram", "Time a stage spent on each call to work/work_batch", LATENCY_BUCKETS),
+    "stage_items_total": ("counter", "Items processed by a stage", ()),
+    "stage_errors_total": ("counter", "Items that raised an exception in a stage", ()),
+    "stage_dropped_total": ("counter", "Items a stage skipped because a newer one was already queued", ()),
+    "audio_seconds_total": ("counter", "Seconds of audio transcribed", ()),
+    "engine_seconds_total": ("counter", "Seconds of transcription each table used, when several share the engine", ()),
+    "transcribe_real_time_factor": ("histogram", "Decode time divided by audio duration", RATIO_BUCKETS),
+    "openai_retries_total": ("counter", "OpenAI requests retried after a timeout, rate limit, or server error", ()),
+    "summary_cycles_total": ("counter", "Summary intervals, by whether they were summarized or skipped", ()),
+    "summary_tokens": ("histogram", "Tokens of dialogue sent to each summarization", TOKEN_BUCKETS),
+    "summary_input_tokens": (
+        "histogram",
+        "Tokens of prompt, dialogue, and notes sent to the LLM per summary",
+        TOKEN_BUCKETS,
+    ),
+    "buffer_tokens": ("gauge", "Tokens currently held in the text buffer", ()),
+    "buffer_lines": ("gauge", "Lines currently held in the text buffer", ()),
+    "end_to_end_seconds": (
+        "histogram",
+        "Time from speech being captured to its image being served, on the session clock",
+        LATENCY_BUCKETS,
+    ),
+    "startup_seconds": ("gauge", "Seconds after process start that each startup phase finished", ()),
+    "process_resident_bytes": ("gauge", "Resident memory of the whole process", ()),
+    "server_cached_images": ("gauge", "Images the server is holding in memory", ()),
+    "server_cached_image_bytes": ("gauge", "Bytes of images the server is holding in memory", ()),
+    "server_image_bytes_total": ("counter", "Bytes of image sent to viewers, by variant", ()),
+}
+
+LabelKey = t.Tuple[t.Tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self, buckets: t.Sequence[float]) -> None:
+        self.buckets: t.Sequence[float] = buckets
+        self.counts: t.List[int] = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum: float = 0.0
+        self.count: int = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Process-wide registry of counters, gauges, and histograms, readable in Prometheus' text format or as JSON.
+    Gauges can be given a function instead of a value, which is called whenever the metrics are read."""
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._values: t.Dict[str, t.Dict[LabelKey, t.Any]] = {name: {} for name in DEFINITIONS}
+
+    def inc(self, name: str, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            values = self._values[name]
+            values[key] = values.get(key, 0.0) + amount
+
+    def set(self, name: str, value: float | t.Callable[[], float], **labels: str) -> None:
+        with self._lock:
+            self._values[name][self._key(labels)] = value
+
+    def unset(self, name: str, **labels: str) -> None:
+        """Forgets a gauge, e.g. one that's being re-registered under different labels"""
+        with self._lock:
+            self._values[name].pop(self._key(labels), None)
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            values = self._values[name]
+            if (histogram := values.get(key)) is None:
+                histogram = values[key] = Histogram(DEFINITIONS[name][2])
+            histogram.observe(value)
+
+    @staticmethod
+    def _key(labels: t.Dict[str, str]) -> LabelKey:
+        return tuple(sorted(labels.items()))
+
+    @staticmethod
+    def _labels(key: LabelKey, **extra: str) -> str:
+        pairs = list(key) + list(extra.items())
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}" if pairs else ""
+
+    def _read(self, value: t.Any) -> float:
+        return float(value()) if callable(value) else float(value)
+
+    def prometheus(self) -> str:
+        """Everything, in Prometheus' text exposition format"""
+        lines: t.List[str] = []
+        with self._lock:
+            for name, values in self._values.items():
+                kind, help_text, _buckets = DEFINITIONS[name]
+                full_name = f"{PREFIX}_{name}"
+                lines += [f"# HELP {full_name} {help_text}", f"# TYPE {full_name} {kind}"]
+                for key, value in values.items():
+                    if isinstance(value, Histogram):
+                        cumulative = 0
+                        for bound, count in zip(list(value.buckets) + [float("inf")], value.counts):
+                            cumulative += count
+                            le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                            lines.append(f"{full_name}_bucket{self._labels(key, le=le)} {cumulative}")
+                        lines.append(f"{full_name}_sum{self._labels(key)} {value.sum:g}")
+                        lines.append(f"{full_name}_count{self._labels(key)} {value.count}")
+                    else:
+                        lines.append(f"{full_name}{self._labels(key)} {self._read(value):g}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> t.Dict[str, t.List[t.Dict[str, t.Any]]]:
+        """Everything, as plain data. Histograms are reduced to their count, sum, mean, and bucket counts."""
+        out: t.Dict[str, t.List[t.Dict[str, t.Any]]] = {}
+        with self._lock:
+            for name, values in self._values.items():
+                out[name] = []
+                for key, value in values.items():
+                    entry: t.Dict[str, t.Any] = {"labels": dict(key)}
+                    if isinstance(value, Histogram):
+                        entry.update(
+                            count=value.count,
+                            sum=value.sum,
+                            mean=value.sum / value.count if value.count else 0.0,
+                            buckets=dict(zip([f"{b:g}" for b in value.buckets] + ["+Inf"], value.counts)),
+                        )
+                    else:
+                        entry["value"] = self._read(value)
+                    out[name].append(entry)
+        return out
+
+    def memory_report(self) -> str:
+        """One line on what's taking up memory, for sizing containers"""
+        with self._lock:
+            total = {
+                name: sum(self._read(value) for value in values.values())
+                for name, values in self._values.items()
+                if DEFINITIONS[name][0] == "gauge"
+            }
+        return (
+            f"Memory: {total['process_resident_bytes'] / 1e6:.0f} MB resident; "
+            f"server holds {total['server_cached_images']:.0f} images "
+            f"({total['server_cached_image_bytes'] / 1e6:.1f} MB); "
+            f"text buffer holds {total['buffer_lines']:.0f} lines ({total['buffer_tokens']:.0f} tokens)"
+        )
+
+    def dump(self, path: Path) -> None:
+        with open(path, "w") as outf:
+            json.dump(self.snapshot(), outf, indent=2)
+
+
+def resident_bytes() -> float:
+    """Current resident memory of this process. Falls back to the peak where /proc isn't available."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        try:
+            import resource
+        except ImportError:  # Windows
+            return 0.0
+        # kilobytes on Linux, bytes on macOS; this is only a rough guide anyway
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+metrics = Metrics()
+metrics.set("process_resident_bytes", resident_bytes)
@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import random
+import typing as t
+from concurrent.futures import Future
+from functools import lru_cache
+from threading import Thread
+
+from .metrics import metrics
+
+if t.TYPE_CHECKING:
+    from openai import AsyncOpenAI, OpenAI
+
+BACKOFF_SECONDS = 1.0  # doubled after each failed attempt, plus some jitter
+
+# The openai package takes a second or so to import, so it's only imported once a client is needed
+
+
+@lru_cache(maxsize=None)
+def sync_client() -> "OpenAI":
+    """The blocking client, shared by every stage that doesn't use an AsyncOpenAIBackend"""
+    from openai import OpenAI
+
+    return OpenAI()
+
+
+def retryable_errors() -> t.Tuple[t.Type[Exception], ...]:
+    from openai import (
+        APIConnectionError,
+        APITimeoutError,
+        InternalServerError,
+        RateLimitError,
+    )
+
+    return (APIConnectionError, APITimeoutError, InternalServerError, RateLimitError)
+
+
+class AsyncOpenAIBackend:
+    """Makes OpenAI requests from a single asyncio event loop running on its own thread. Stages call chat() and
+    images() from their threads and block on the result, as they would with the synchronous client, but every
+    request has a timeout, failed requests are retried with jittered backoff, and no more than `concurrency`
+    requests per model are in flight at once."""
+
+    def __init__(self, concurrency: int = 2, timeout: float = 120.0, retries: int = 3) -> None:
+        self.logger = logging.getLogger("AsyncOpenAIBackend")
+        self.concurrency: int = concurrency
+        self.timeout: float = timeout
+        self.retries: int = retries
+        self._semaphores: t.Dict[str, asyncio.Semaphore] = {}
+        self._retryable: t.Tuple[t.Type[Exception], ...] = ()
+
+        self.loop = asyncio.new_event_loop()
+        Thread(target=self.loop.run_forever, name="AsyncOpenAIBackend", daemon=True).start()
+        # made on the loop's thread, which also takes care of importing openai without holding up startup
+        self._client: Future[AsyncOpenAI] = asyncio.run_coroutine_threadsafe(self._make_client(), self.loop)
+
+    async def _make_client(self) -> "AsyncOpenAI":
+        from openai import AsyncOpenAI
+
+        self._retryable = retryable_errors()
+        # we do our own retrying, so the client shouldn't
+        return AsyncOpenAI(timeout=self.timeout, max_retries=0)
+
+    @property
+    def client(self) -> "AsyncOpenAI":
+        return self._client.result()
+
+    def wait_until_ready(self) -> None:
+        self._client.result()
+
+    def chat(self, **kwargs: t.Any) -> t.Any:
+        """client.chat.completions.create(**kwargs), from any thread"""
+        return self._run(kwargs["model"], self.client.chat.completions.create, kwargs)
+
+    def images(self, **kwargs: t.Any) -> t.Any:
+        """client.images.generate(**kwargs), from any thread"""
+        return self._run(kwargs["model"], self.client.images.generate, kwargs)
+
+    def _run(self, model: str, method: t.Callable[..., t.Awaitable[t.Any]], kwargs: t.Dict[str, t.Any]) -> t.Any:
+        return asyncio.run_coroutine_threadsafe(self._request(model, method, kwargs), self.loop).result()
+
+    async def _request(
+        self, model: str, method: t.Callable[..., t.Awaitable[t.Any]], kwargs: t.Dict[str, t.Any]
+    ) -> t.Any:
+        if (semaphore := self._semaphores.get(model)) is None:
+            semaphore = self._semaphores[model] = asyncio.Semaphore(self.concurrency)
+        async with semaphore:
+            for attempt in range(self.retries + 1):
+                try:
+                    return await method(**kwargs)
+                except self._retryable as e:
+                    if attempt == self.retries:
+                        raise
+                    delay = self._retry_after(e) or BACKOFF_SECONDS * 2**attempt * random.uniform(0.5, 1.5)
+                    metrics.inc("openai_retries_total", model=model)
+                    self.logger.warning("%s request failed (%s), retrying in %.1fs", model, type(e).__name__, delay)
+                    await asyncio.sleep(delay)
+
+    @staticmethod
+    def _retry_after(error: Exception) -> float | None:
+        if (response := getattr(error, "response", None)) is not None and response.status_code == 429:
+            try:
+                return float(response.headers.get("retry-after", ""))
+            except ValueError:
+                pass
+        return None
+
+    def close(self) -> None:
+        try:
+            if self._client.exception(timeout=5) is None:  # there's nothing to close if it was never made
+                asyncio.run_coroutine_threadsafe(self.client.close(), self.loop).result(timeout=5)
+        except Exception as e:
+            self.logger.error("failed to close the OpenAI client: %s", e)
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
@@ -4,6 +4,8 @@ from pathlib import Path
 PROMPTS_FOLDER = Path(__file__).parent.joinpath("prompts")
 IMAGE_EXTENSION = PROMPTS_FOLDER.joinpath("image_extra.txt")
 SUMMARY = PROMPTS_FOLDER.joinpath("summary.txt")
+SUMMARY_UPDATE = PROMPTS_FOLDER.joinpath("summary_update.txt")
+ROLLING_SUMMARY = PROMPTS_FOLDER.joinpath("rolling_summary.txt")
 
 
 class PromptManager:
@@ -1,31 +1,94 @@
+import typing as t
 from base64 import b64decode
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from datetime import datetime
+from functools import partial
 
-from openai import OpenAI
-
+from .cache import DiskCache
+from .openai_backend import AsyncOpenAIBackend, sync_client
 from .prompts import IMAGE_EXTENSION, PromptManager
 from .util import AsyncThread, Image, Summary
 
 
 class ImageRenderer(AsyncThread):
-    def __init__(self, model: str, image_size: str, image_quality: str, image_style: str) -> None:
+    def __init__(
+        self,
+        model: str,
+        image_size: str,
+        image_quality: str,
+        image_style: str,
+        cache: DiskCache | None = None,
+        candidates: int = 1,
+        candidate_styles: t.Sequence[str] | None = None,
+        backend: AsyncOpenAIBackend | None = None,
+    ) -> None:
         super().__init__("ImageRenderer")
-        self.openai_client: OpenAI = OpenAI()
+        self.backend: AsyncOpenAIBackend | None = backend
         self.model: str = model
         self.size: str = image_size
         self.image_quality: str = image_quality
         self.image_style: str = image_style
         self.prompt_manager = PromptManager()
+        self.cache: DiskCache | None = cache
+
+        # With several candidates, they're all requested at once and whichever finishes first is shown. The rest
+        # are handed to on_alternate as they come in. Styles are cycled through if more than one is given.
+        self.candidates: int = max(1, candidates)
+        self.candidate_styles: t.List[str] = list(candidate_styles or [image_style])
+        self.on_alternate: t.Callable[[Image, int], t.Any] | None = None
+        # twice as many threads as candidates, so stragglers don't hold up the next summary's renders
+        self.pool = ThreadPoolExecutor(max_workers=self.candidates * 2, thread_name_prefix="ImageRenderer")
 
     def work(self, summary: Summary) -> Image | None:
         """Sends the text to OpenAI, spits out an Image"""
+        prompt = summary.summary + "\n" + self.prompt_manager.get_prompt(IMAGE_EXTENSION)
+        if self.cache is not None:
+            cached = [
+                image_bytes
+                for style, repeat in self._styles()
+                if (image_bytes := self.cache.get(self._cache_key(prompt, style, repeat))) is not None
+            ]
+            if cached:
+                self.logger.info("Using cached image, with %d cached alternates", len(cached) - 1)
+                for number, image_bytes in enumerate(cached[1:], start=1):
+                    if self.on_alternate is not None:
+                        self.on_alternate(Image.from_summary(summary, image_bytes), number)
+                return Image.from_summary(summary, cached[0])
+
+        if self.candidates == 1:
+            image_bytes = self._render_and_cache(prompt, self.image_style, 0)
+        else:
+            image_bytes = self._render_candidates(summary, prompt)
+        if image_bytes is None:
+            return None
+        return Image.from_summary(summary, image_bytes)
+
+    def _styles(self) -> t.List[t.Tuple[str, int]]:
+        """The style of each candidate, and how many candidates before it had the same style"""
+        if self.candidates == 1:
+            return [(self.image_style, 0)]
+        count = len(self.candidate_styles)
+        return [(self.candidate_styles[i % count], i // count) for i in range(self.candidates)]
+
+    def _cache_key(self, prompt: str, style: str, repeat: int) -> str:
+        parts = ["image", self.model, prompt, self.size, self.image_quality, style]
+        return DiskCache.key(*parts, *([str(repeat)] if repeat else []))
+
+    def _render_and_cache(self, prompt: str, style: str, repeat: int) -> bytes | None:
+        image_bytes = self._render(prompt, style)
+        if image_bytes is not None and self.cache is not None:
+            self.cache.put(self._cache_key(prompt, style, repeat), image_bytes)
+        return image_bytes
+
+    def _render(self, prompt: str, style: str) -> bytes | None:
         start = datetime.now()
-        data = self.openai_client.images.generate(
+        generate = self.backend.images if self.backend is not None else sync_client().images.generate
+        data = generate(
             model=self.model,
-            prompt=summary.summary + "\n" + self.prompt_manager.get_prompt(IMAGE_EXTENSION),
+            prompt=prompt,
             size=self.size,  # type: ignore[arg-type]
             quality=self.image_quality,  # type: ignore[arg-type]
-            style=self.image_style,  # type: ignore[arg-type]
+            style=style,  # type: ignore[arg-type]
             response_format="b64_json",
             n=1,
         ).data
@@ -35,4 +98,43 @@ class ImageRenderer(AsyncThread):
         rendered = data[0]
         self.logger.info("Rendered in %s", datetime.now() - start)
 
-        return Image.from_summary(summary, b64decode(rendered.b64_json)) if rendered.b64_json is not None else None
+        if rendered.b64_json is None:
+            return None
+        return b64decode(rendered.b64_json)
+
+    def _render_candidates(self, summary: Summary, prompt: str) -> bytes | None:
+        """Requests all the candidates concurrently and returns the first to finish. Each is cached as it comes in."""
+        futures = {
+            self.pool.submit(self._render_and_cache, prompt, style, repeat): style for style, repeat in self._styles()
+        }
+        error: Exception | None = None
+        for future in as_completed(futures):
+            style = futures.pop(future)
+            try:
+                image_bytes = future.result()
+            except Exception as e:
+                self.logger.warning("A candidate render failed: %s", e)
+                error = e
+                continue
+            if image_bytes is not None:
+                self.logger.info("Showing the first render (%s), %d more on the way", style, len(futures))
+                for number, other in enumerate(futures, start=1):
+                    other.add_done_callback(partial(self._save_alternate, summary, number=number))
+                return image_bytes
+        if error is not None:
+            raise error
+        return None
+
+    def _save_alternate(self, summary: Summary, future: "Future[bytes | None]", number: int) -> None:
+        try:
+            image_bytes = future.result()
+        except Exception as e:
+            self.logger.warning("An alternate render failed: %s", e)
+            return
+        if image_bytes is not None and self.on_alternate is not None:
+            self.on_alternate(Image.from_summary(summary, image_bytes), number)
+
+    def stop(self, drain: bool = True, timeout: float | None = None) -> bool:
+        stopped = super().stop(drain, timeout)
+        self.pool.shutdown(wait=drain, cancel_futures=not drain)  # let the alternates finish so they get saved
+        return stopped
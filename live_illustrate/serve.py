@@ -1,11 +1,50 @@
+import logging
 import typing as t
-from base64 import b64encode
+from base64 import b64decode
+from collections import OrderedDict
+from io import BytesIO
+from pathlib import Path
+from threading import Condition, RLock
 
-from flask import Flask, Response, send_from_directory
+from flask import Flask, Response, render_template, request, send_file
+from PIL import Image as PILImage
+from werkzeug.middleware.dispatcher import DispatcherMiddleware
 
-from .util import Image
+from .clock import SessionClock
+from .imaging import MIME_TYPES, VARIANT_WIDTHS, data_uri
+from .metrics import metrics
+from .util import Image, Transcription, image_etag
 
-IMAGE_HTML = """<div hx-get="/image/{index}" hx-trigger="every 5s" hx-swap="outerHTML transition:true" class="imgbox"><img src='data:image/png;base64, {image_b64}' class='center-fit'/></div>"""
+# URLs start with {root}, the path the app is mounted at (see MultiTableServer), so they work whether or not the
+# viewer page was loaded with a trailing slash. Tags for the newest image are made ahead of time with {root} left in.
+# The viewer gets new images over server-sent events, and polls every so often in case the stream isn't getting through.
+IMAGE_HTML = (
+    """<div hx-get="{root}/image/{index}" hx-trigger="every 30s" hx-swap="outerHTML transition:true" """
+    """class="imgbox">{img}</div>"""
+)
+
+IMG_TAG = """<img src='{root}/images/{index}' class='center-fit'/>"""
+# Lets the browser pick a size for the screen, with a tiny blurry copy of the image to show until it's loaded
+RESPONSIVE_IMG_TAG = (
+    """<img src='{root}/images/{index}' srcset='{srcset}' sizes='100vw' class='center-fit' """
+    """style="background-image: url('{placeholder}'); background-size: cover"/>"""
+)
+TABLES_HTML = """<!doctype html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1.0">
+<title>AutoDraw</title>
+</head>
+<body><ul>{links}</ul></body>
+</html>"""
+ORIGINAL = "original.png"
+SSE_KEEPALIVE_SECONDS = 15.0  # comment lines sent to idle subscribers so proxies don't drop the connection
+RESERVED_THREADS = 8  # worker threads kept free of event streams, for page loads and image downloads
+
+DEFAULT_IMAGE = b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNk+A8AAQUBAScY42YAAAAASUVORK5CYII="
+)
 
 
 class ImageServer:
@@ -13,30 +52,273 @@ class ImageServer:
         self,
         host: str,
         port: int,
-        default_image: str = "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNk+A8AAQUBAScY42YAAAAASUVORK5CYII=",
+        default_image: bytes = DEFAULT_IMAGE,
+        backend: str = "flask",
+        threads: int = 64,
+        keepalive: int = 120,
+        max_cached_images: int = 16,
+        clock: SessionClock | None = None,
     ) -> None:
+        self.logger = logging.getLogger("ImageServer")
         self.host: str = host
         self.port: int = port
+        self.backend: str = backend
+        self.threads: int = threads
+        self.keepalive: int = keepalive
+        # Every open event stream ties up a worker thread, so leave a few for everything else
+        self.max_subscribers: int = max(1, threads - RESERVED_THREADS)
+        # images are timestamped on the session clock, which follows the audio when processing a recording
+        self.clock: SessionClock = clock if clock is not None else SessionClock()
 
-        self.images: t.List[str] = [default_image]
+        # Indexed by image id. Browsers fetch each image once and revalidate it by ETag. Only the most recent
+        # images are kept in memory, along with their variants; older ones are served from where SessionData
+        # saved them, if anywhere, as the original PNG.
+        # Requests are handled on many threads while the renderer appends, so all access goes through _lock.
+        self.etags: t.List[str] = []
+        self.paths: t.List[Path | None] = []
+        self.max_cached_images: int = max(1, max_cached_images)
+        self._recent: t.OrderedDict[int, t.Dict[str, bytes]] = OrderedDict()
+        self._latest_tag: str = ""  # <img> for the newest image, which is all the viewers are ever sent
+        self.cached_bytes: int = 0
+        self._lock = RLock()
+        self._new_image = Condition(self._lock)  # wakes up the event streams whenever update_image is called
+        self.subscribers: int = 0
+        self.partial: Transcription = Transcription("")  # what's being said right now, in streaming mode
+        self._add_image({ORIGINAL: default_image})
+        self._register_gauges()
 
         self.app = Flask(__name__)
 
         self.app.add_url_rule("/", "index", self.serve_index)
         self.app.add_url_rule("/image/<index>", "image", self.serve_image_tag)
+        self.app.add_url_rule("/images/<int:image_id>", "image_file", self.serve_image_file)
+        self.app.add_url_rule("/latest", "latest", self.serve_latest)
+        self.app.add_url_rule("/partial", "partial", self.serve_partial)
+        self.app.add_url_rule("/events", "events", self.serve_events)
+        self.app.add_url_rule("/metrics", "metrics", self.serve_metrics)
+
+    def _register_gauges(self, **labels: str) -> None:
+        metrics.set("server_cached_images", lambda: len(self._recent), **labels)
+        metrics.set("server_cached_image_bytes", lambda: self.cached_bytes, **labels)
 
-    def serve_index(self) -> Response:
-        return send_from_directory("templates", "index.html")
+    def for_table(self, table: str) -> None:
+        """Tells this server's logs and metrics apart from other tables', when it's mounted on a MultiTableServer"""
+        self.logger = logging.getLogger(f"ImageServer.{table}")
+        metrics.unset("server_cached_images")
+        metrics.unset("server_cached_image_bytes")
+        self._register_gauges(table=table)
 
-    def serve_image_tag(self, index: str) -> str:
-        """Sneaky image handler that counts up by index until we get to the most recent image,
-        using HTMX to re-request the endpoint every few seconds."""
+    def serve_index(self) -> str:
+        return render_template("index.html")
+
+    def serve_image_tag(self, index: str) -> str | t.Tuple[str, int]:
+        """Polling fallback for clients without server-sent events. Jumps straight to the most recent image,
+        using HTMX to re-request the endpoint every so often. Once the client is caught up, it gets an
+        empty 204 (which HTMX leaves alone) rather than the same image again."""
         my_index: int = int(index) if index.isdigit() else -1
-        next_index: int = min(max(0, my_index + 1), len(self.images) - 1)
-        return IMAGE_HTML.format(index=next_index, image_b64=self.images[next_index])
+        with self._lock:
+            latest, img = self.latest_id, self._latest_tag
+        if latest == my_index:
+            return "", 204
+        return IMAGE_HTML.format(root=request.script_root, index=latest, img=img.format(root=request.script_root))
+
+    def serve_image_file(self, image_id: int) -> Response | t.Tuple[str, int]:
+        """The image at ?size=full (the default) or ?size=small, as WebP if the browser takes it or JPEG if not.
+        ?size=original, and any image without variants, gets the PNG as rendered."""
+        size = request.args.get("size", "full")
+        variant = f"{size}.{'webp' if 'image/webp' in request.headers.get('Accept', '') else 'jpeg'}"
+        with self._lock:
+            if not 0 <= image_id < len(self.etags):
+                return "No such image", 404
+            etag, path = self.etags[image_id], self.paths[image_id]
+            if (variants := self._recent.get(image_id)) is not None:
+                self._recent.move_to_end(image_id)
+                variant = variant if variant in variants else ORIGINAL
+        if variants is not None:
+            image_bytes = variants[variant]
+            sent_bytes = len(image_bytes)
+            response = send_file(
+                BytesIO(image_bytes),
+                mimetype=MIME_TYPES[variant.split(".")[1]],
+                etag=f"{etag}-{variant}",
+                max_age=0,
+                conditional=True,
+            )
+            response.vary.add("Accept")
+        elif path is not None and path.exists():
+            variant, sent_bytes = ORIGINAL, path.stat().st_size
+            response = send_file(
+                path.absolute(), mimetype="image/png", etag=f"{etag}-{variant}", max_age=0, conditional=True
+            )
+        else:
+            return "Image is no longer available", 404
+        if response.status_code == 200:
+            metrics.inc("server_image_bytes_total", sent_bytes, variant=variant)
+        return response
+
+    def serve_latest(self) -> t.Dict[str, t.Any]:
+        """Tiny response for clients that just want to know whether there's something new"""
+        return {"id": self.latest_id}
+
+    def serve_partial(self) -> t.Dict[str, t.Any]:
+        """The streaming transcriber's latest guess at what's being said, for live captions"""
+        partial = self.partial
+        return {"text": partial.transcription, "timestamp": partial.timestamp}
+
+    def update_partial(self, partial: Transcription) -> None:
+        self.partial = partial
+
+    def serve_events(self) -> Response | t.Tuple[str, int, t.Dict[str, str]]:
+        """Server-sent event stream that pushes the newest image to the viewer as soon as it's rendered"""
+        with self._lock:
+            if self.subscribers >= self.max_subscribers:
+                return "Too many viewers", 503, {"Retry-After": str(int(SSE_KEEPALIVE_SECONDS))}
+            self.subscribers += 1
+        response = Response(
+            self._image_events(request.script_root),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+        response.call_on_close(self._unsubscribe)
+        return response
+
+    def _image_events(self, root: str) -> t.Iterator[str]:
+        sent = -1
+        while True:
+            with self._new_image:
+                self._new_image.wait_for(lambda: len(self.etags) - 1 > sent, timeout=SSE_KEEPALIVE_SECONDS)
+                latest, img = len(self.etags) - 1, self._latest_tag
+            if latest == sent:
+                yield ": keepalive\n\n"
+                continue
+            sent = latest
+            html = IMAGE_HTML.format(root=root, index=latest, img=img.format(root=root))
+            yield f"event: image\ndata: {html}\n\n"
+
+    def serve_metrics(self) -> Response:
+        """Pipeline metrics, for Prometheus to scrape"""
+        return Response(metrics.prometheus(), mimetype="text/plain; version=0.0.4")
+
+    def _unsubscribe(self) -> None:
+        with self._lock:
+            self.subscribers -= 1
+
+    @property
+    def latest_id(self) -> int:
+        with self._lock:
+            return len(self.etags) - 1
+
+    def start(self) -> None:
+        run_app(self.app, self.host, self.port, self.backend, self.threads, self.keepalive, self.logger)
+
+    def update_image(self, image: Image, path: Path | None = None) -> None:
+        """Shows the image to viewers, along with any variants made by the ImageProcessor. If it's saved at `path`,
+        it can be dropped from memory later on."""
+        self._add_image({ORIGINAL: image.image_bytes, **image.variants}, path)
+        if image.timestamp is not None:
+            metrics.observe("end_to_end_seconds", self.clock.now() - image.timestamp)
+
+    def update_placeholder(self, image_bytes: bytes) -> None:
+        """Shows this instead of the blank image from startup, unless something has been rendered already"""
+        with self._lock:
+            if self.latest_id == 0:
+                self._add_image({ORIGINAL: image_bytes})
+
+    def restore_image(self, path: Path, etag: str) -> None:
+        """Shows an image from a resumed session. It's served from disk, so nothing needs to be read yet."""
+        with self._new_image:
+            self.etags.append(etag)
+            self.paths.append(path)
+            self._latest_tag = IMG_TAG.format(root="{root}", index=len(self.etags) - 1)
+            self._new_image.notify_all()
+
+    def _add_image(self, variants: t.Dict[str, bytes], path: Path | None = None) -> None:
+        with self._new_image:
+            index = len(self.etags)
+            self._recent[index] = variants
+            self.cached_bytes += sum(len(data) for data in variants.values())
+            self.etags.append(image_etag(variants[ORIGINAL]))
+            self.paths.append(path)
+            self._latest_tag = self._img_tag(index, variants)
+            while len(self._recent) > self.max_cached_images:
+                self.cached_bytes -= sum(len(data) for data in self._recent.popitem(last=False)[1].values())
+            self._new_image.notify_all()
+
+    def _img_tag(self, index: int, variants: t.Dict[str, bytes]) -> str:
+        if (placeholder := variants.get("placeholder.jpeg")) is None:
+            return IMG_TAG.format(root="{root}", index=index)
+        with PILImage.open(BytesIO(variants[ORIGINAL])) as original:  # only reads the header
+            widths = {size: width or original.width for size, width in VARIANT_WIDTHS.items()}
+        srcset = ", ".join(
+            f"{{root}}/images/{index}?size={size} {width}w"
+            for size, width in widths.items()
+            if f"{size}.jpeg" in variants
+        )
+        return RESPONSIVE_IMG_TAG.format(root="{root}", index=index, srcset=srcset, placeholder=data_uri(placeholder))
+
+
+class MultiTableServer:
+    """Serves the viewers for several tables from one port, each ImageServer's app mounted at /t/<table>/, with a
+    list of the tables at / and the process-wide metrics at /metrics. The ImageServers are never start()ed
+    themselves. Event streams hold a worker thread each, so the threads left over are split between the tables."""
+
+    def __init__(
+        self,
+        servers: t.Dict[str, ImageServer],
+        host: str,
+        port: int,
+        backend: str = "flask",
+        threads: int = 64,
+        keepalive: int = 120,
+    ) -> None:
+        self.logger = logging.getLogger("MultiTableServer")
+        self.servers: t.Dict[str, ImageServer] = servers
+        self.host: str = host
+        self.port: int = port
+        self.backend: str = backend
+        self.threads: int = threads
+        self.keepalive: int = keepalive
+        for table, server in servers.items():
+            server.for_table(table)
+            server.max_subscribers = max(1, (threads - RESERVED_THREADS) // max(1, len(servers)))
+
+        self.app = Flask(__name__)
+        self.app.add_url_rule("/", "index", self.serve_index)
+        self.app.add_url_rule("/metrics", "metrics", self.serve_metrics)
+        self.app.wsgi_app = DispatcherMiddleware(  # type: ignore[method-assign]
+            self.app.wsgi_app, {f"/t/{table}": server.app for table, server in servers.items()}
+        )
+
+    def serve_index(self) -> str:
+        return TABLES_HTML.format(links="".join(f"<li><a href='t/{table}/'>{table}</a></li>" for table in self.servers))
+
+    def serve_metrics(self) -> Response:
+        """Pipeline metrics for every table, for Prometheus to scrape"""
+        return Response(metrics.prometheus(), mimetype="text/plain; version=0.0.4")
 
     def start(self) -> None:
-        self.app.run(host=self.host, port=self.port)
+        run_app(self.app, self.host, self.port, self.backend, self.threads, self.keepalive, self.logger)
+
 
-    def update_image(self, image: Image) -> None:
-        self.images.append(b64encode(image.image_bytes).decode("utf-8"))
+def run_app(
+    app: Flask, host: str, port: int, backend: str, threads: int, keepalive: int, logger: logging.Logger
+) -> None:
+    """Serves the app until the process exits, with waitress if it's asked for and installed, or Flask if not"""
+    if backend == "waitress":
+        try:
+            from waitress import serve  # type: ignore
+        except ImportError:
+            logger.warning("waitress is not installed (pip install live_illustrate[server]), using Flask")
+        else:
+            logger.info("Serving on %s:%d with %d threads", host, port, threads)
+            serve(
+                app,
+                host=host,
+                port=port,
+                threads=threads,
+                channel_timeout=keepalive,  # how long an idle keep-alive connection is held open
+                connection_limit=max(1000, threads * 8),  # idle keep-alive connections are cheap
+                ident="live_illustrate",
+            )
+            return
+    app.run(host=host, port=port, threaded=True)
@@ -1,77 +1,208 @@
+import json
 import logging
 import os
+import typing as t
 from datetime import datetime
 from pathlib import Path
+from threading import Thread
 
-from discord import File, SyncWebhook
-
-from .util import Image, Summary, Transcription
+from .checkpoint import CHECKPOINT_FILE, Record
+from .clock import SessionClock
+from .discord_upload import DiscordUploader
+from .metrics import metrics
+from .util import AsyncThread, Image, Summary, Transcription, image_etag
 
 DISCORD_WEBHOOK = "DISCORD_WEBHOOK"
+COMMIT_INTERVAL = 0.5  # seconds; everything that arrives in this window is written (and flushed) together
+UPLOAD_DRAIN_SECONDS = 30.0  # how long to wait on queued discord uploads at shutdown
 
 
 class SessionData:
-    """Creates a data/<timestamp> folder for the session and stores images, summaries, and transcripts"""
+    """Creates a data/<timestamp> folder for the session and stores images, summaries, and transcripts, along with
+    a checkpoint (see checkpoint.py) to resume it from. With `resume`, data_dir is an existing session's folder,
+    which is carried on with instead. The save_* methods only queue the data, so they never block the pipeline on
+    the disk or the network."""
 
-    def __init__(self, data_dir: Path, echo: bool = True) -> None:
+    def __init__(
+        self,
+        data_dir: Path,
+        echo: bool = True,
+        discord_max_bytes: int = 8_000_000,
+        discord_format: str = "png",
+        dump_metrics: bool = False,
+        clock: SessionClock | None = None,
+        resume: bool = False,
+    ) -> None:
         self.start_time = datetime.now()
         self.logger = logging.getLogger("SessionData")
+        # files are named by session time, which runs ahead of the wall clock when processing a recording
+        self.clock: SessionClock = clock if clock is not None else SessionClock()
 
-        self.data_dir: Path = data_dir.joinpath(self.start_time.strftime("%Y_%m_%d-%H_%M_%S"))
+        self.resume: bool = resume
+        self.data_dir: Path = data_dir if resume else data_dir.joinpath(self.start_time.strftime("%Y_%m_%d-%H_%M_%S"))
         self.echo: bool = echo
+        self.dump_metrics: bool = dump_metrics
 
         self.discord_webhook: str | None = os.getenv(DISCORD_WEBHOOK)
+        self.uploader: DiscordUploader | None = None
         if self.discord_webhook is not None:
             self.logger.info("Discord upload is enabled")
+            self.uploader = DiscordUploader(self.discord_webhook, discord_max_bytes, discord_format)
 
-    def save_image(self, image: Image) -> None:
-        try:
-            fname = self.data_dir.joinpath(f"{self._time_since}.png")
-            with open(fname, "wb") as outf:
-                outf.write(image.image_bytes)
-        except Exception as e:
-            self.logger.error("failed to save image to file: %s", e)
-        else:
-            try:
-                if self.discord_webhook is not None:
-                    with open(fname, "rb") as image_file:
-                        SyncWebhook.from_url(self.discord_webhook).send(
-                            file=File(image_file, description=image.summary[:1023])
-                        )
-            except Exception as e:
-                self.logger.error("failed to send image to discord: %s", e)
+        self.writer = SessionWriter(self)
+
+    def for_table(self, table: str) -> None:
+        """Tells this session's logs and metrics, and its writer's and uploader's, apart from other tables'"""
+        self.logger = logging.getLogger(f"SessionData.{table}")
+        self.writer.for_table(table)
+        if self.uploader is not None:
+            self.uploader.for_table(table)
+
+    def save_image(self, image: Image) -> Path:
+        """saves the image to its own file, and returns where that will be"""
+        time_since = self._time_since(image)
+        self.writer.send("image", time_since, image)
+        return self.data_dir.joinpath(f"{time_since}.png")
+
+    def save_alternate(self, image: Image, number: int) -> None:
+        """saves a runner-up render next to the image that was shown, without uploading it"""
+        self.writer.send("alternate", f"{self._time_since(image)}_alt{number}", image)
 
     def save_summary(self, summary: Summary) -> None:
-        """saves the provided text to its own file"""
-        try:
-            with open(self.data_dir.joinpath(f"{self._time_since}.txt"), "w") as summaryf:
-                print(summary.summary, file=summaryf)
-        except Exception as e:
-            self.logger.error("failed to write summary to file: %s", e)
+        """saves the provided text to its own file, and the scene notes to another if it has them"""
+        self.writer.send("summary", self._time_since(summary), summary)
 
     def save_transcription(self, transcription: Transcription) -> None:
         """appends the provided text to the transcript file"""
-        try:
-            with open(self.data_dir.joinpath("transcript.txt"), "a") as transf:
-                if self.echo:
-                    print(self._time_since, ">", transcription.transcription)
-                print(self._time_since, ">", transcription.transcription, file=transf, flush=True)
-        except Exception as e:
-            self.logger.error("failed to write transcript to file: %s", e)
+        self.writer.send("transcription", self._time_since(transcription), transcription)
+
+    def checkpoint(self, record: Record) -> None:
+        """appends a record to the checkpoint, stamped with how far into the session it is"""
+        self.writer.send("checkpoint", "", {**record, "e": round(self.clock.elapsed(), 2)})
 
     @property
-    def _time_since(self) -> str:
-        delta = datetime.now() - self.start_time
-        minutes, seconds = divmod(delta.seconds, 60)
+    def queue_depth(self) -> int:
+        """Number of writes waiting on the background writer"""
+        return self.writer.queue.qsize()
+
+    def _time_since(self, item: Transcription) -> str:
+        minutes, seconds = divmod(int(self.clock.elapsed_at(item.timestamp)), 60)
         hours, minutes = divmod(minutes, 60)
 
         return f"{hours}h_{minutes:02}m_{seconds:02}s"
 
     def __enter__(self) -> "SessionData":  # create the directories upon entry, not upon init
-        if not (parent := self.data_dir.parent).exists():
-            parent.mkdir()
-        self.data_dir.mkdir()
+        self.data_dir.parent.mkdir(parents=True, exist_ok=True)
+        if not self.resume:
+            self.data_dir.mkdir()
+        Thread(target=self.writer.start, args=(lambda _: None,), daemon=True).start()
+        if self.uploader is not None:
+            Thread(target=self.uploader.start, args=(lambda _: None,), daemon=True).start()
         return self
 
     def __exit__(self, *exc) -> None:
-        pass
+        if not self.writer.stop():
+            self.logger.warning("%d writes were not saved", self.queue_depth)
+        self.writer.close()
+        # the writer feeds the uploader, so it has to be stopped second
+        if self.uploader is not None and not self.uploader.stop(timeout=UPLOAD_DRAIN_SECONDS):
+            self.logger.warning("%d images were not uploaded to discord", self.uploader.queue.qsize())
+        if self.dump_metrics:
+            try:
+                metrics.dump(self.data_dir.joinpath("metrics.json"))
+            except Exception as e:
+                self.logger.error("failed to write metrics to file: %s", e)
+
+
+class SessionWriter(AsyncThread):
+    """Background thread that does SessionData's file writes and hands images off for upload. Transcript lines and
+    checkpoint records go through a single open handle each, and are flushed once per batch rather than once per
+    line."""
+
+    def __init__(self, session: SessionData) -> None:
+        super().__init__("SessionWriter")
+        self.session = session
+        self.batch_size = 256
+        self._transcript: t.TextIO | None = None
+        self._checkpoint: t.TextIO | None = None
+
+    def work(self, kind: str, time_since: str, item: t.Any) -> None:
+        self.work_batch([(kind, time_since, item)])
+
+    def work_batch(self, batch: t.List[t.Tuple[t.Any, ...]]) -> t.List[None]:
+        for kind, time_since, item in batch:
+            if kind == "transcription":
+                self._write_transcription(time_since, item)
+            elif kind == "summary":
+                self._write_summary(time_since, item)
+            elif kind == "image":
+                self._write_image(time_since, item)
+            elif kind == "alternate":
+                self._write_image(time_since, item, upload=False)
+            elif kind == "checkpoint":
+                self._write_checkpoint(item)
+        for handle in (self._transcript, self._checkpoint):
+            if handle is not None:
+                try:
+                    handle.flush()
+                except Exception as e:
+                    self.logger.error("failed to write %s: %s", handle.name, e)
+        self.logger.debug("Committed %d writes, %d still queued", len(batch), self.queue.qsize())
+        # give the next few writes a moment to pile up, so they get committed together
+        self._stop_event.wait(COMMIT_INTERVAL)
+        return []
+
+    def _write_transcription(self, time_since: str, transcription: Transcription) -> None:
+        try:
+            if self._transcript is None:
+                self._transcript = open(self.session.data_dir.joinpath("transcript.txt"), "a")
+            if self.session.echo:
+                print(time_since, ">", transcription.transcription)
+            print(time_since, ">", transcription.transcription, file=self._transcript)
+        except Exception as e:
+            self.logger.error("failed to write transcript to file: %s", e)
+
+    def _write_summary(self, time_since: str, summary: Summary) -> None:
+        try:
+            with open(self.session.data_dir.joinpath(f"{time_since}.txt"), "w") as summaryf:
+                print(summary.summary, file=summaryf)
+            if summary.scene is not None:
+                with open(self.session.data_dir.joinpath(f"{time_since}_scene.txt"), "w") as scenef:
+                    print(summary.scene, file=scenef)
+        except Exception as e:
+            self.logger.error("failed to write summary to file: %s", e)
+        self._write_checkpoint(
+            {"k": "summary", "summary": summary.summary, "scene": summary.scene, "e": self._elapsed(summary)}
+        )
+
+    def _write_image(self, time_since: str, image: Image, upload: bool = True) -> None:
+        try:
+            with open(self.session.data_dir.joinpath(f"{time_since}.png"), "wb") as outf:
+                outf.write(image.image_bytes)
+        except Exception as e:
+            self.logger.error("failed to save image to file: %s", e)
+        else:
+            if upload:  # alternates aren't shown, so a resumed session doesn't need them
+                etag = image_etag(image.image_bytes)
+                self._write_checkpoint(
+                    {"k": "image", "path": f"{time_since}.png", "etag": etag, "e": self._elapsed(image)}
+                )
+        if upload and self.session.uploader is not None:
+            self.session.uploader.send(image, time_since)
+
+    def _write_checkpoint(self, record: Record) -> None:
+        try:
+            if self._checkpoint is None:
+                self._checkpoint = open(self.session.data_dir.joinpath(CHECKPOINT_FILE), "a")
+            print(json.dumps(record, separators=(",", ":")), file=self._checkpoint)
+        except Exception as e:
+            self.logger.error("failed to write checkpoint to file: %s", e)
+
+    def _elapsed(self, item: Transcription) -> float:
+        return round(self.session.clock.elapsed_at(item.timestamp), 2)
+
+    def close(self) -> None:
+        for handle in (self._transcript, self._checkpoint):
+            if handle is not None:
+                handle.close()
+        self._transcript = self._checkpoint = None
@@ -0,0 +1,111 @@
+import logging
+import os
+import signal
+import socket
+import typing as t
+from _thread import interrupt_main
+from concurrent.futures import Future
+from threading import Thread, main_thread
+from time import perf_counter, sleep
+
+from .metrics import metrics
+
+PROBE_SECONDS = 0.02  # how often to check whether the server is accepting connections yet
+SERVER_START_TIMEOUT = 30.0  # seconds to keep checking before giving up on it
+
+
+def process_started() -> float:
+    """perf_counter() as of when this process started, so imports count towards startup. Falls back to now where
+    /proc isn't available."""
+    try:
+        with open("/proc/self/stat") as stat, open("/proc/uptime") as uptime:
+            # the command name (field 2) can have spaces in it, so count fields from the closing paren
+            start_ticks = int(stat.read().rsplit(")", 1)[1].split()[19])
+            age = float(uptime.read().split()[0]) - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        age = 0.0
+    return perf_counter() - max(0.0, age)
+
+
+def interrupt_main_thread() -> None:
+    """Sends the main thread a SIGINT, as if ctrl+c had been pressed. A real signal (where there's pthread_kill)
+    also wakes it up from a blocking join() or read, which interrupt_main() alone doesn't."""
+    if hasattr(signal, "pthread_kill"):
+        signal.pthread_kill(main_thread().ident, signal.SIGINT)  # type: ignore[arg-type]
+    else:
+        interrupt_main()
+
+
+class StartupTimer:
+    """Times each phase of starting up, counting from process start. The slow ones (loading models and the like)
+    run in the background via background(), and report() logs a breakdown once all of them are done."""
+
+    def __init__(self) -> None:
+        self.logger = logging.getLogger("Startup")
+        self.started: float = process_started()
+        self.phases: t.Dict[str, float] = {}  # phase -> seconds after process start that it finished
+        self._background: t.List[Future[t.Any]] = []
+        self.failed: t.List[str] = []  # required phases that didn't make it
+
+    def mark(self, phase: str) -> None:
+        self.phases[phase] = perf_counter() - self.started
+        metrics.set("startup_seconds", self.phases[phase], phase=phase)
+        self.logger.debug("%s after %.2fs", phase, self.phases[phase])
+
+    def background(self, phase: str, func: t.Callable[[], t.Any], required: bool = False) -> "Future[t.Any]":
+        """Runs func on its own thread, and marks the phase once it's done. Its result (or error) goes to the
+        returned future. If a required phase fails, the main thread gets a KeyboardInterrupt, so the app shuts
+        down the same way it would on ctrl+c instead of running on without it."""
+        future: Future[t.Any] = Future()
+
+        def run() -> None:
+            try:
+                future.set_result(func())
+            except Exception as e:
+                if required:
+                    self.logger.critical("%s failed, shutting down: %s", phase, e)
+                    self.failed.append(phase)
+                    interrupt_main_thread()
+                else:
+                    self.logger.error("%s failed: %s", phase, e)
+                future.set_exception(e)
+            finally:
+                self.mark(phase)
+
+        Thread(target=run, name=phase, daemon=True).start()
+        self._background.append(future)
+        return future
+
+    def wait_for_server(self, host: str, port: int, server_thread: Thread) -> None:
+        """Marks "serving" once the server accepts connections. Gives up if server_thread dies first (it couldn't
+        bind the port, say) or it takes more than SERVER_START_TIMEOUT."""
+
+        def probe() -> None:
+            address = ("127.0.0.1" if host in ("0.0.0.0", "") else host, port)
+            deadline = perf_counter() + SERVER_START_TIMEOUT
+            while server_thread.is_alive():
+                try:
+                    socket.create_connection(address, timeout=1).close()
+                    return
+                except OSError:
+                    if perf_counter() > deadline:
+                        raise TimeoutError(f"nothing listening on port {port} after {SERVER_START_TIMEOUT}s")
+                    sleep(PROBE_SECONDS)
+            raise RuntimeError("the server stopped before it started accepting connections")
+
+        self.background("serving", probe)
+
+    def report(self) -> None:
+        """Logs the breakdown once everything started with background() has finished"""
+
+        def log_when_done() -> None:
+            for future in self._background:
+                future.exception()  # waits, without raising
+            self.mark("ready")
+            self.logger.info(
+                "Ready after %.1fs (%s)",
+                self.phases["ready"],
+                ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in self.phases.items() if phase != "ready"),
+            )
+
+        Thread(target=log_when_done, daemon=True).start()
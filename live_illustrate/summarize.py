@@ -1,41 +1,76 @@
+import re
 from datetime import datetime
 
-from openai import OpenAI
-
-from .prompts import SUMMARY, PromptManager
+from .cache import DiskCache
+from .metrics import metrics
+from .openai_backend import AsyncOpenAIBackend, sync_client
+from .prompts import ROLLING_SUMMARY, SUMMARY, SUMMARY_UPDATE, PromptManager
 from .util import AsyncThread, Summary, Transcription, num_tokens_from_string
 
+ROLLING_RESPONSE = re.compile(r"SCENE:\s*(?P<scene>.*?)\s*ILLUSTRATION:\s*(?P<summary>.*)", re.DOTALL | re.IGNORECASE)
+
 
 class TextSummarizer(AsyncThread):
-    def __init__(self, model: str) -> None:
+    def __init__(self, model: str, cache: DiskCache | None = None, backend: AsyncOpenAIBackend | None = None) -> None:
         super().__init__("TextSummarizer")
-        self.openai_client: OpenAI = OpenAI()
+        self.backend: AsyncOpenAIBackend | None = backend
         self.model: str = model
         self.prompt_manager = PromptManager()
+        self.cache: DiskCache | None = cache
 
-    def work(self, transcription: Transcription) -> Summary | None:
-        """Sends the big buffer of provided text to ChatGPT, returns bullets describing the setting"""
+    def work(
+        self, transcription: Transcription, previous: Summary | None = None, scene: str | None = None
+    ) -> Summary | None:
+        """Sends the big buffer of provided text to ChatGPT, returns bullets describing the setting.
+        If a previous summary is given, the text is treated as new dialogue since then, and the summary is
+        revised rather than written from scratch. If scene notes are given (even empty ones), the text is new
+        dialogue since those were written, and the summary comes back with updated notes for next time."""
         text = transcription.transcription
         if (token_count := num_tokens_from_string(text)) == 0:
             self.logger.info("No tokens in transcription, skipping summarization")
             return None
+        metrics.observe("summary_tokens", token_count)
+
+        if scene is not None:
+            prompt = self.prompt_manager.get_prompt(ROLLING_SUMMARY)
+            user_content = f"Scene so far:\n{scene or '(nothing yet)'}\n\nNew dialogue:\n{text}"
+        elif previous is not None:
+            prompt = self.prompt_manager.get_prompt(SUMMARY_UPDATE)
+            user_content = f"Current illustration:\n{previous.summary}\n\nNew dialogue:\n{text}"
+            transcription = Transcription(
+                previous.transcription + "\n" + text, timestamp=transcription.timestamp or previous.timestamp
+            )
+        else:
+            prompt, user_content = self.prompt_manager.get_prompt(SUMMARY), text
+
+        if self.cache is not None:
+            cache_key = DiskCache.key("summary", self.model, prompt, user_content)
+            if (cached := self.cache.get(cache_key)) is not None:
+                self.logger.info("Using cached summary for %d tokens", token_count)
+                return self._parse(transcription, cached.decode("utf-8"), scene)
+        metrics.observe("summary_input_tokens", num_tokens_from_string(prompt) + num_tokens_from_string(user_content))
 
         start = datetime.now()
-        response = self.openai_client.chat.completions.create(
+        create = self.backend.chat if self.backend is not None else sync_client().chat.completions.create
+        response = create(
             model=self.model,
             messages=[
-                {"role": "system", "content": self.prompt_manager.get_prompt(SUMMARY)},
-                {"role": "user", "content": text},
+                {"role": "system", "content": prompt},
+                {"role": "user", "content": user_content},
             ],
         )
         self.logger.info("Summarized %d tokens in %s", token_count, datetime.now() - start)
-        if response.choices:
-            return [
-                (
-                    Summary.from_transcription(transcription, content.strip())
-                    if (content := choice.message.content)
-                    else None
-                )
-                for choice in response.choices
-            ][-1]
+        if response.choices and (content := response.choices[-1].message.content):
+            if self.cache is not None:
+                self.cache.put(cache_key, content.strip().encode("utf-8"))
+            return self._parse(transcription, content.strip(), scene)
         return None
+
+    def _parse(self, transcription: Transcription, content: str, scene: str | None) -> Summary:
+        """Splits a rolling summary into the illustration and the scene notes. Anything else is just the summary."""
+        if scene is None:
+            return Summary.from_transcription(transcription, content)
+        if (match := ROLLING_RESPONSE.search(content)) is None:
+            self.logger.warning("Rolling summary didn't follow the format, keeping the previous scene notes")
+            return Summary.from_transcription(transcription, content, scene=scene)
+        return Summary.from_transcription(transcription, match["summary"].strip(), scene=match["scene"].strip())
@@ -0,0 +1,132 @@
+import logging
+import typing as t
+from threading import Thread
+
+import speech_recognition as sr  # type: ignore
+
+from .audio_sources import WavSource
+from .imaging import ImageProcessor
+from .render import ImageRenderer
+from .serve import ImageServer
+from .session_data import SessionData
+from .summarize import TextSummarizer
+from .text_buffer import TextBuffer
+from .transcribe import AudioTranscriber
+from .util import (
+    AsyncThread,
+    Image,
+    Summary,
+    Transcription,
+    is_transcription_interesting,
+)
+from .whisper_engine import SAMPLE_RATE
+
+
+def audio_source(source: str, replay_speed: float = 1.0) -> sr.AudioSource:
+    """The default microphone for "", the microphone with that index for a number (see
+    sr.Microphone.list_microphone_names()), or a recording to play back in real time for anything else"""
+    if not source:
+        return sr.Microphone(sample_rate=SAMPLE_RATE)
+    if source.isdigit():
+        return sr.Microphone(device_index=int(source), sample_rate=SAMPLE_RATE)
+    return WavSource(source, speed=replay_speed)
+
+
+class Table:
+    """One table's pipeline, with its own transcriber, text buffer, summarizer, renderer, session folder, and viewer.
+    Without --tables there's just the one, named "" and served at the root. With it, each stage has its own queue,
+    so one table falling behind doesn't hold up the others; the Whisper model (through a FairScheduler), the OpenAI
+    clients, and the ImageProcessor are shared. With --oneshot there's no transcriber, and lines are fed straight
+    to on_text_transcribed."""
+
+    def __init__(
+        self,
+        name: str,
+        transcriber: AudioTranscriber | None,
+        buffer: TextBuffer,
+        summarizer: TextSummarizer,
+        renderer: ImageRenderer,
+        server: ImageServer,
+        session_data: SessionData,
+        processor: ImageProcessor | None = None,
+    ) -> None:
+        self.name: str = name
+        self.logger = logging.getLogger(f"Table.{name}" if name else "Table")
+        self.transcriber = transcriber
+        self.buffer = buffer
+        self.summarizer = summarizer
+        self.renderer = renderer
+        self.server = server
+        self.session_data = session_data
+        self.processor = processor
+        # upstream first, so whatever they flush on the way out still gets handled downstream
+        self.stages: t.List[AsyncThread] = [
+            stage for stage in (transcriber, buffer, summarizer, renderer) if stage is not None
+        ]
+        if name:
+            for stage in self.stages:
+                stage.for_table(name)
+            session_data.for_table(name)
+
+    @property
+    def viewer_path(self) -> str:
+        return f"/t/{self.name}/" if self.name else "/"
+
+    def on_text_transcribed(self, transcription: Transcription) -> None:
+        if is_transcription_interesting(transcription):
+            self.session_data.save_transcription(transcription)
+            self.buffer.send(transcription)
+
+    def on_summary_generated(self, summary: Summary | None) -> None:
+        if summary:
+            self.session_data.save_summary(summary)
+            self.renderer.send(summary)
+
+    def on_image_rendered(self, image: Image | None) -> None:
+        if image:
+            path = self.session_data.save_image(image)
+            if self.processor is not None:
+                self.processor.send(image, path, self.name)  # comes back to the server through the processor
+            else:
+                self.server.update_image(image, path)
+
+    def start(self) -> None:
+        """Starts each stage on its own threads. The session folder should already have been entered."""
+        self.renderer.on_alternate = self.session_data.save_alternate
+        self.buffer.on_checkpoint = self.session_data.checkpoint
+        if self.transcriber is not None:
+            self.transcriber.on_partial = self.server.update_partial
+            Thread(target=self.transcriber.start, args=(self.on_text_transcribed,), daemon=True).start()
+        Thread(target=self.summarizer.start, args=(self.on_summary_generated,), daemon=True).start()
+        Thread(target=self.renderer.start, args=(self.on_image_rendered,), daemon=True).start()
+        Thread(target=self.buffer.start, args=(lambda _len: None,), daemon=True).start()
+        if self.buffer.rolling:
+            Thread(
+                target=self.buffer.rolling_forever,
+                args=(self.summarizer.submit, self.on_summary_generated),
+                daemon=True,
+            ).start()
+        elif self.buffer.lead_seconds > 0:
+            Thread(
+                target=self.buffer.pipeline_forever,
+                args=(self.summarizer.submit, self.on_summary_generated),
+                daemon=True,
+            ).start()
+        else:
+            Thread(target=self.buffer.buffer_forever, args=(self.summarizer.send,), daemon=True).start()
+        self.logger.info("Viewer is at %s, saving to %s", self.viewer_path, self.session_data.data_dir)
+
+    def finish(self) -> None:
+        """Waits for a recording to run out, then for everything said in it to be summarized and rendered"""
+        if self.transcriber is not None:
+            self.transcriber.finished_reading.wait()
+            self.transcriber.stop()
+        self.buffer.stop()
+        self.buffer.flush(self.summarizer.send)  # the end of the recording, since the last summary
+        self.summarizer.stop()
+        self.renderer.stop()
+
+    def stop(self, timeout: float | None = None) -> None:
+        for stage in self.stages:
+            if not stage.stop(timeout=timeout):
+                stage.logger.warning("Still busy after %ss, giving up on remaining work", timeout)
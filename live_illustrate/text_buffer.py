@@ -1,43 +1,351 @@
 import typing as t
-from datetime import datetime
-from time import sleep
+from bisect import bisect_left
+from concurrent.futures import Future
+from itertools import accumulate
+from threading import Event, Lock
 
-from .util import AsyncThread, Transcription, get_last_n_tokens, num_tokens_from_string
+from .checkpoint import Record
+from .clock import SessionClock
+from .metrics import metrics
+from .util import AsyncThread, Summary, Transcription, num_tokens_from_string
+
+ACTIVITY_CHECK_SECONDS = 5.0  # how often to look at the volume of new dialogue, when summaries can come early
 
 
 class TextBuffer(AsyncThread):
-    def __init__(self, wait_minutes: float, max_context: int, persistence: float = 1.0) -> None:
+    def __init__(
+        self,
+        wait_minutes: float,
+        max_context: int,
+        persistence: float = 1.0,
+        lead_seconds: float = 0.0,
+        clock: SessionClock | None = None,
+        max_lines: int = 5000,
+        rolling: bool = False,
+        min_wait_minutes: float | None = None,
+        trigger_tokens: int = 0,
+        min_new_tokens: int = 0,
+        max_similarity: float = 1.0,
+    ) -> None:
         super().__init__("TextBuffer")
         self.buffer: t.List[Transcription] = []
-        self.wait_seconds: int = int(wait_minutes * 60)
+        # Running token totals: _cumulative_tokens[i] - _cumulative_tokens[0] is the number of tokens in buffer[:i].
+        # Each line is only ever tokenized once, so picking a window is a binary search instead of a re-encode.
+        self._cumulative_tokens: t.List[int] = [0]
+        self._lock = Lock()
+        self.lines_added: int = 0  # never goes down, even when the buffer is trimmed
+        self.summarized_through: int = 0  # lines_added as of the last context handed off to be summarized
+        self.tokens_added: int = 0  # likewise, for tokens
+        self._tokens_at_summary: int = 0
+        self._summarized_words: t.Set[str] = set()  # words in the last context handed off to be summarized
+
+        # Summaries are scheduled by how much is being said. One comes every wait_seconds, unless fewer than
+        # min_new_tokens have been said since the last (a break, say) or what was said is at least max_similarity
+        # made up of words from the last one, in which case that interval is skipped. If trigger_tokens are said
+        # before then, it comes early, but no sooner than min_wait_seconds after the last.
+        self.wait_seconds: float = wait_minutes * 60
+        self.min_wait_seconds: float = self.wait_seconds if min_wait_minutes is None else min_wait_minutes * 60
+        self.trigger_tokens: int = trigger_tokens
+        self.min_new_tokens: int = min_new_tokens
+        self.max_similarity: float = max_similarity
         self.max_context: int = max_context
+        # hard cap, since with persistence at 1.0 nothing is ever trimmed otherwise
+        self.max_lines: int = max(1, max_lines)
         self.persistence: float = persistence
+        self.lead_seconds: float = lead_seconds
+        # summary intervals are measured on the session clock, which runs ahead of the wall clock for recordings
+        self.clock: SessionClock = clock if clock is not None else SessionClock()
+        # With rolling summaries, the transcript is folded into these notes on the scene as it goes, and only
+        # what came in after scene_through (a lines_added mark) is sent along with them
+        self.rolling: bool = rolling
+        self.scene: str = ""
+        self.scene_through: int = 0
+        self._rolling_done = Event()  # clear while rolling_forever is running, so flush() can wait it out
+        self._rolling_done.set()
+        # given a record of everything that changes the buffer's state, so it can be restored (see checkpoint.py)
+        self.on_checkpoint: t.Callable[[Record], t.Any] | None = None
+        self._resumed_interval_start: float | None = None  # when the last summary was, in a resumed session
+        self._register_gauges()
+
+    def _register_gauges(self, **labels: str) -> None:
+        metrics.set("buffer_tokens", lambda: self.token_count, **labels)
+        metrics.set("buffer_lines", lambda: len(self.buffer), **labels)
+
+    def for_table(self, table: str) -> None:
+        super().for_table(table)
+        metrics.unset("buffer_tokens")
+        metrics.unset("buffer_lines")
+        self._register_gauges(table=table)
 
     def work(self, next_transcription: Transcription) -> int:
         """Very simple, just puts the text in the buffer. The real work is done in buffer_forever."""
-        self.buffer.append(next_transcription)
-        return len(self.buffer)
+        # +1 for the newline that joins this line to the next one
+        token_count = num_tokens_from_string(next_transcription.transcription) + 1
+        with self._lock:
+            self.buffer.append(next_transcription)
+            self._cumulative_tokens.append(self._cumulative_tokens[-1] + token_count)
+            self.lines_added += 1
+            self.tokens_added += token_count
+            self._checkpoint({"k": "line", "text": next_transcription.transcription, "tokens": token_count})
+            if (excess := len(self.buffer) - self.max_lines) > 0:
+                del self.buffer[:excess]
+                del self._cumulative_tokens[:excess]
+                self._checkpoint_trim()
+            length = len(self.buffer)
+        if next_transcription.timestamp is not None:
+            self.clock.advance_to(next_transcription.timestamp)
+        return length
 
-    def get_context(self) -> Transcription:
+    @property
+    def token_count(self) -> int:
+        """Total number of tokens currently held in the buffer"""
+        return self._cumulative_tokens[-1] - self._cumulative_tokens[0]
+
+    def _start_of_last_n_tokens(self, n: int) -> int:
+        """Index of the first line in the longest suffix of the buffer that fits in n tokens"""
+        return bisect_left(self._cumulative_tokens, self._cumulative_tokens[-1] - n, hi=len(self.buffer))
+
+    def get_context(self, trim: bool = True) -> Transcription:
         """Grabs the last max_context tokens from the buffer. If persistence < 1, trims it down
         to at most persistence * 100 %"""
-        as_text = [t.transcription for t in self.buffer]
-        context = Transcription("\n".join(get_last_n_tokens(as_text, self.max_context)))
-        if self.persistence < 1.0:
-            self.buffer = [
-                Transcription(line)
-                for line in get_last_n_tokens(
-                    as_text, int(self.persistence * num_tokens_from_string("\n".join(as_text)))
-                )
-            ]
+        with self._lock:
+            return self._get_context(trim)
+
+    def _get_context(self, trim: bool) -> Transcription:
+        start = self._start_of_last_n_tokens(self.max_context)
+        context = Transcription(
+            "\n".join(t.transcription for t in self.buffer[start:]),
+            timestamp=self.buffer[-1].timestamp if self.buffer else None,
+        )
+        self._mark_summarized(context, self.lines_added, self.tokens_added)
+        if trim and self.persistence < 1.0:
+            keep_from = self._start_of_last_n_tokens(int(self.persistence * self.token_count))
+            self.buffer = self.buffer[keep_from:]
+            self._cumulative_tokens = self._cumulative_tokens[keep_from:]
+            self._checkpoint_trim()
         return context
 
-    def buffer_forever(self, callback: t.Callable[[Transcription], t.Any]) -> None:
-        """every wait_seconds, grabs the last max_context tokens and sends them off to the
-        summarizer (via `callback`)"""
-        last_run = datetime.now()
+    def _get_new_text(self) -> Transcription:
+        """Lines that aren't in the scene notes yet, up to max_context tokens of them. They're only marked as
+        summarized once the notes have been updated with them (see update_scene)."""
+        count = min(self.lines_added - self.scene_through, len(self.buffer))
+        start = max(len(self.buffer) - count, self._start_of_last_n_tokens(self.max_context))
+        if (dropped := start - (len(self.buffer) - count)) > 0:
+            self.logger.warning("Leaving %d lines out of the scene notes, since they don't fit in max_context", dropped)
+        return Transcription(
+            "\n".join(t.transcription for t in self.buffer[start:]),
+            timestamp=self.buffer[-1].timestamp if self.buffer else None,
+        )
+
+    def _mark_summarized(self, context: Transcription, lines: int, tokens: int) -> None:
+        """Records that everything up to `lines` (and `tokens`) has gone into a summary"""
+        self.summarized_through = lines
+        self._tokens_at_summary = tokens
+        if self.max_similarity < 1.0:
+            self._summarized_words = set(context.transcription.lower().split())
+        self._checkpoint({"k": "summarized", "lines": lines, "tokens": tokens})
+
+    def _checkpoint(self, record: Record) -> None:
+        if self.on_checkpoint is not None:
+            self.on_checkpoint(record)
+
+    def _checkpoint_trim(self) -> None:
+        self._checkpoint({"k": "trim", "first": self.lines_added - len(self.buffer)})
+
+    def restore(self, records: t.List[Record]) -> None:
+        """Picks up where a checkpointed session left off, without re-tokenizing anything. The clock should
+        already have been resumed, and nothing added to the buffer yet."""
+        lines: t.List[Transcription] = []
+        tokens: t.List[int] = []
+        first = 0
+        for record in records:
+            if (kind := record["k"]) == "line":
+                lines.append(Transcription(record["text"], timestamp=self.clock.start + record["e"]))
+                tokens.append(record["tokens"])
+            elif kind == "trim":
+                first = record["first"]
+            elif kind == "summarized":
+                self.summarized_through, self._tokens_at_summary = record["lines"], record["tokens"]
+                self._resumed_interval_start = self.clock.start + record["e"]
+            elif kind == "scene":
+                self.scene, self.scene_through = record["scene"], record["through"]
+        with self._lock:
+            self.lines_added, self.tokens_added = len(lines), sum(tokens)
+            first = max(first, len(lines) - self.max_lines)
+            self.buffer = lines[first:]
+            self._cumulative_tokens = list(accumulate(tokens[first:], initial=0))
+
+    @property
+    def new_tokens(self) -> int:
+        """Tokens added since the last context was handed off to be summarized"""
+        return self.tokens_added - self._tokens_at_summary
+
+    def _skip_reason(self) -> t.Tuple[str, str] | None:
+        """Why another summary isn't worth it yet, if it isn't: too little has been said since the last one, or
+        too little of it is new. As (metric label, explanation)."""
+        if (new_tokens := self.new_tokens) < max(1, self.min_new_tokens):
+            return "skipped_quiet", f"only {new_tokens} new tokens since the last one"
+        if self.max_similarity < 1.0 and self._summarized_words:
+            new_words = {
+                word
+                for line in self.lines_since(self.summarized_through)
+                for word in line.transcription.lower().split()
+            }
+            similarity = len(new_words & self._summarized_words) / max(1, len(new_words))
+            if similarity >= self.max_similarity:
+                return "skipped_similar", f"{similarity:.0%} of the words said since the last one were already in it"
+        return None
+
+    def _skip(self) -> bool:
+        """Whether to skip this interval's summary. Logs why, if so."""
+        if (reason := self._skip_reason()) is None:
+            return False
+        self.logger.info("Skipping this summary: %s", reason[1])
+        metrics.inc("summary_cycles_total", outcome=reason[0])
+        return True
+
+    def _wait_for_next_summary(self) -> bool:
+        """Sleeps until it's time to summarize again, skipping intervals that aren't worth it (see __init__).
+        Returns True if stop() was called first."""
+        interval_start = self._resumed_interval_start or self.clock.now()
+        self._resumed_interval_start = None
+        early = self.trigger_tokens > 0 and self.min_wait_seconds < self.wait_seconds
         while True:
-            if (datetime.now() - last_run).seconds > self.wait_seconds:
-                last_run = datetime.now()
-                callback(self.get_context())
-            sleep(1)
+            elapsed = self.clock.now() - interval_start
+            if (
+                early
+                and elapsed >= self.min_wait_seconds
+                and self.new_tokens >= self.trigger_tokens
+                and self._skip_reason() is None
+            ):
+                self.logger.info("%d new tokens after %.0fs, summarizing early", self.new_tokens, elapsed)
+                metrics.inc("summary_cycles_total", outcome="summarized_early")
+                return False
+            if elapsed >= self.wait_seconds:
+                if not self._skip():
+                    metrics.inc("summary_cycles_total", outcome="summarized")
+                    return False
+                interval_start, elapsed = self.clock.now(), 0.0
+            deadline = interval_start + self.wait_seconds
+            if early:
+                deadline = min(deadline, interval_start + max(self.min_wait_seconds, elapsed + ACTIVITY_CHECK_SECONDS))
+            if self.clock.wait_until(deadline, self._stop_event):
+                return True
+
+    def update_scene(self, summary: Summary, mark: int, tokens: int, new_text: Transcription) -> None:
+        """Takes on the notes from a rolling summary of new_text, which ran up to `mark` (and `tokens`), and lets
+        go of those lines"""
+        with self._lock:
+            self._mark_summarized(new_text, mark, tokens)
+            if summary.scene is not None:
+                self.scene = summary.scene
+            self.scene_through = mark
+            self._checkpoint({"k": "scene", "scene": self.scene, "through": mark})
+            if (folded := len(self.buffer) - (self.lines_added - mark)) > 0:
+                del self.buffer[:folded]
+                del self._cumulative_tokens[:folded]
+                self._checkpoint_trim()
+
+    def lines_since(self, mark: int) -> t.List[Transcription]:
+        """Everything added to the buffer after lines_added was equal to `mark`"""
+        with self._lock:
+            count = min(self.lines_added - mark, len(self.buffer))
+            return self.buffer[-count:] if count > 0 else []
+
+    def buffer_forever(self, callback: t.Callable[[Transcription], t.Any]) -> None:
+        """every wait_seconds (or sooner or later, depending on how much is being said), grabs the last max_context
+        tokens and sends them off to the summarizer (via `callback`). Returns once stop() is called."""
+        while not self._wait_for_next_summary():
+            callback(self.get_context())
+
+    def flush(self, callback: t.Callable[..., t.Any]) -> None:
+        """Sends off whatever has come in since the last summary, e.g. the end of a recording. Call stop() first;
+        a rolling summary that's still in flight is waited on, so its lines aren't summarized twice."""
+        self._rolling_done.wait()
+        with self._lock:
+            if self.lines_added <= self.summarized_through:
+                return
+            if self.rolling:
+                context, scene = self._get_new_text(), self.scene
+                self._mark_summarized(context, self.lines_added, self.tokens_added)  # there's no next time
+            else:
+                context = self._get_context(trim=True)
+        if self.rolling:
+            callback(context, None, scene)
+        else:
+            callback(context)
+
+    def rolling_forever(
+        self,
+        submit: t.Callable[..., "Future[Summary | None]"],
+        callback: t.Callable[[Summary], t.Any],
+    ) -> None:
+        """Like buffer_forever, but every wait_seconds only the lines since the last summary are sent, along with
+        the scene notes that summary left behind, so the tokens per summary don't grow with the session.
+        Waits on each summary so the next one builds on its notes; if one fails, its lines go out with the next,
+        and that interval isn't skipped for being quiet.
+        `submit` is the summarizer's submit method."""
+        self._rolling_done.clear()
+        try:
+            while not self._wait_for_next_summary():
+                with self._lock:
+                    mark, tokens, scene = self.lines_added, self.tokens_added, self.scene
+                    new_text = self._get_new_text()
+                if not new_text.transcription:
+                    continue
+                try:
+                    summary = submit(new_text, None, scene).result(timeout=self.wait_seconds)
+                except Exception as e:
+                    self.logger.error("Failed to summarize: %s", e)
+                    continue
+                if summary is not None:
+                    self.update_scene(summary, mark, tokens, new_text)
+                    callback(summary)
+        finally:
+            self._rolling_done.set()
+
+    def pipeline_forever(
+        self,
+        submit: t.Callable[..., "Future[Summary | None]"],
+        callback: t.Callable[[Summary], t.Any],
+    ) -> None:
+        """Like buffer_forever, but starts summarizing lead_seconds ahead of each deadline. At the deadline,
+        only the lines that came in since then are folded into that summary, so the finished summary goes to
+        `callback` (the renderer) right at the deadline instead of a whole summarization later. Since the deadline
+        has to be known ahead of time, summaries never come early, but quiet intervals are still skipped.
+        `submit` is the summarizer's submit method."""
+        next_run = (self._resumed_interval_start or self.clock.now()) + self.wait_seconds
+        self._resumed_interval_start = None
+        while not self.clock.wait_until(next_run - self.lead_seconds, self._stop_event):
+            if self._skip():
+                next_run = self.clock.now() + self.wait_seconds
+                continue
+            with self._lock:
+                mark, early_context = self.lines_added, self._get_context(trim=False)
+            speculative = submit(early_context)
+            if self.clock.wait_until(next_run, self._stop_event):
+                return
+            next_run = self.clock.now() + self.wait_seconds
+
+            new_lines = self.lines_since(mark)
+            context = self.get_context()
+            try:
+                summary = speculative.result(timeout=self.wait_seconds)
+            except Exception as e:
+                self.logger.warning("Speculative summary failed (%s), summarizing from scratch", e)
+                summary = None
+
+            try:
+                if summary is not None and new_lines:
+                    self.logger.info("Updating summary with %d new lines", len(new_lines))
+                    new_text = Transcription(
+                        "\n".join(line.transcription for line in new_lines), timestamp=new_lines[-1].timestamp
+                    )
+                    summary = submit(new_text, summary).result(timeout=self.wait_seconds)
+                elif summary is None:
+                    summary = submit(context).result(timeout=self.wait_seconds)
+            except Exception as e:
+                self.logger.error("Failed to summarize: %s", e)
+                continue
+            if summary is not None:
+                callback(summary)
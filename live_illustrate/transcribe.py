@@ -1,44 +1,229 @@
 import typing as t
+from queue import Empty
+from threading import Event, Thread, current_thread
+from time import perf_counter, sleep, time
 
+import numpy as np
 import speech_recognition as sr  # type: ignore
 
+from .audio_sources import AudioFileSource
+from .clock import SessionClock
+from .metrics import metrics
 from .util import AsyncThread, Transcription
+from .whisper_engine import (
+    SAMPLE_RATE,
+    TableEngine,
+    WhisperEngine,
+    WhisperPool,
+    audio_to_array,
+)
 
 # TODO - might want to figure out how to lower the pause detection threshold.
 # Our party talks a lot.
 DYNAMIC_ENERGY_THRESHOLD = True
-SAMPLE_RATE = 16000
+
+# Streaming mode
+BYTES_PER_SECOND = SAMPLE_RATE * 2  # 16-bit mono
+STREAM_MAX_WINDOW_SECONDS = 25.0  # force a commit before the window outgrows Whisper's 30s input
+STREAM_TAIL_SECONDS = 1.0  # speech this close to the end of the window may still be mid-word
+STREAM_BATCH_SIZE = 512  # microphone chunks are tiny, so take everything that's waiting
+_FLUSH = object()
+
+# Recordings are read no further ahead of the transcriber than this many batches
+FILE_READ_AHEAD_BATCHES = 2
 
 
 class AudioTranscriber(AsyncThread):
-    def __init__(self, model: str, phrase_timeout: float, compute_type: str) -> None:
+    def __init__(
+        self,
+        engine: WhisperEngine | WhisperPool | TableEngine,
+        phrase_timeout: float,
+        batch_size: int = 8,
+        stream_seconds: float = 0.0,
+        source: sr.AudioSource | None = None,
+        clock: SessionClock | None = None,
+        max_backlog: int = 0,
+    ) -> None:
         super().__init__("AudioTranscriber")
 
         self.recorder = sr.Recognizer()
-        self.source = sr.Microphone(sample_rate=SAMPLE_RATE)
-        self.model = model
-        self.compute_type = compute_type
+        self.source = source if source is not None else sr.Microphone(sample_rate=SAMPLE_RATE)
+        self.engine = engine
         self.phrase_timeout = int(phrase_timeout * 60)
+        # phrases that pile up while whisper is busy get decoded together
+        self.batch_size = batch_size
+        # when this many phrases are waiting on whisper, the oldest is dropped; 0 lets them pile up
+        self.max_backlog: int = max_backlog
 
         self.recorder.dynamic_energy_threshold = DYNAMIC_ENERGY_THRESHOLD
+        self._stop_listening: t.Callable[..., None] | None = None
+        self.clock: SessionClock = clock if clock is not None else SessionClock()
+        self.finished_reading = Event()  # set once a recording (as opposed to a microphone) runs out
 
-    def work(self, _, audio_data) -> Transcription:
+        # In streaming mode, raw microphone audio accumulates in a rolling window. Every stream_seconds the
+        # uncommitted part is decoded again; speech that has settled is committed and dropped from the window.
+        self.stream_seconds: float = stream_seconds
+        self.partial: str = ""  # latest guess at the speech that hasn't been committed yet
+        # given each new partial (or "" once it's been committed or turned out to be silence), separately from the
+        # committed text that goes to the callback
+        self.on_partial: t.Callable[[Transcription], t.Any] | None = None
+        self._window = bytearray()
+        self._window_end_time: float = 0.0
+        self._undecoded_bytes: int = 0
+        self._hypothesis: t.List[str] = []
+        if stream_seconds > 0:
+            self.batch_size = STREAM_BATCH_SIZE
+            self.retry_failed_batches = False  # the audio is already in the window, so it'd go in twice
+
+    def work(self, captured_at: float, audio_data: sr.AudioData) -> Transcription:
         """Passes audio data to whisper, spits text back out"""
+        return self.work_batch([(captured_at, audio_data)])[0]
+
+    def work_batch(self, batch: t.List[t.Tuple[t.Any, ...]]) -> t.List[Transcription]:
+        if self.stream_seconds > 0:
+            return self._stream(batch)
+        if len(batch) > 1:
+            self.logger.info("Transcribing %d queued phrases together", len(batch))
+        batch = sorted(batch, key=lambda item: item[0])  # hand results on in the order they were spoken
+        phrases = [
+            (
+                audio_data
+                if isinstance(audio_data, np.ndarray)  # already decoded, from a recording
+                else audio_to_array(audio_data.get_raw_data(convert_rate=SAMPLE_RATE, convert_width=2))
+            )
+            for _, audio_data in batch
+        ]
+        start = perf_counter()
+        texts = self.engine.transcribe_batch(phrases)
+        self._record_decode(sum(len(phrase) for phrase in phrases) / SAMPLE_RATE, perf_counter() - start)
+        return [Transcription(text.strip(), timestamp=captured_at) for (captured_at, _), text in zip(batch, texts)]
+
+    def _record_decode(self, audio_seconds: float, elapsed: float) -> None:
+        metrics.inc("audio_seconds_total", audio_seconds)
+        if audio_seconds > 0:
+            metrics.observe("transcribe_real_time_factor", elapsed / audio_seconds)
+
+    def _stream(self, batch: t.List[t.Tuple[t.Any, ...]]) -> t.List[Transcription]:
+        """Adds freshly captured audio to the window, and re-decodes the window once enough has built up"""
+        final = False
+        for captured_at, *frames in batch:
+            if captured_at is _FLUSH:
+                final = True
+                continue
+            self._window.extend(frames[0])
+            self._undecoded_bytes += len(frames[0])
+            self._window_end_time = captured_at
+        if not final and self._undecoded_bytes < self.stream_seconds * BYTES_PER_SECOND:
+            return []
+        self._undecoded_bytes = 0
+        committed = self._decode_window(final)
+        return [committed] if committed is not None else []
+
+    def _decode_window(self, final: bool) -> Transcription | None:
+        window_seconds = len(self._window) / BYTES_PER_SECOND
+        start = perf_counter()
+        segments = self.engine.transcribe_segments(audio_to_array(bytes(self._window)))
+        self._record_decode(window_seconds, perf_counter() - start)
+        if not segments:
+            # nothing but silence; no need to keep decoding it
+            del self._window[: max(0, len(self._window) - int(STREAM_TAIL_SECONDS * BYTES_PER_SECOND))]
+            self._hypothesis = []
+            self._set_partial("")
+            return None
+
+        # A chunk of speech is committed once it's clear of the tail of the window and came out the same way
+        # on the previous pass. If the window is getting too long, settle for being clear of the tail.
+        forced = final or window_seconds > STREAM_MAX_WINDOW_SECONDS
+        settled_before = window_seconds if final else window_seconds - STREAM_TAIL_SECONDS
+        committed = 0
+        for _start, end, text in segments:
+            if end > settled_before or not (forced or text in self._hypothesis):
+                break
+            committed += 1
+        if committed == 0 and window_seconds > STREAM_MAX_WINDOW_SECONDS:
+            committed = len(segments)
+
+        self._hypothesis = [text for _start, _end, text in segments[committed:]]
+        self._set_partial(" ".join(self._hypothesis))
+        if committed == 0:
+            return None
+
+        commit_end = segments[committed - 1][1]
+        del self._window[: int(commit_end * SAMPLE_RATE) * 2]
         return Transcription(
-            self.recorder.recognize_faster_whisper(
-                audio_data,
-                model=self.model,
-                init_options={
-                    "compute_type": self.compute_type,
-                },
-            ).strip()
+            " ".join(text for _start, _end, text in segments[:committed]),
+            timestamp=self._window_end_time - (window_seconds - commit_end),
         )
 
+    def _set_partial(self, partial: str) -> None:
+        if partial == self.partial:
+            return
+        self.partial = partial
+        if partial:
+            self.logger.debug("Partial: %s", partial)
+        if self.on_partial is not None:
+            self.on_partial(Transcription(partial, timestamp=self._window_end_time))
+
+    def on_phrase(self, _recognizer: sr.Recognizer, audio_data: sr.AudioData) -> None:
+        if self.max_backlog > 0 and self.queue.qsize() >= self.max_backlog and not self.stopping:
+            try:
+                self.queue.get_nowait()
+                self.queue.task_done()
+                self.logger.warning("Transcription is %d phrases behind, dropping the oldest", self.max_backlog)
+                metrics.inc("stage_dropped_total", stage=self.stage)
+            except Empty:
+                pass
+        self.send(time(), audio_data)
+
+    def _capture_forever(self) -> None:
+        """Streaming mode: forwards every chunk the microphone produces, without waiting for a pause"""
+        with self.source:
+            while not self.stopping:
+                self.send(time(), self.source.stream.read(self.source.CHUNK))
+
+    def _read_file(self, source: AudioFileSource, worker: Thread) -> None:
+        """Recording mode: queues phrases as fast as whisper gets through them, timestamped in session time.
+        Gives up if `worker`, the thread taking them off the queue, dies (after too many errors, say)."""
+        try:
+            for end, audio in source.phrases():
+                while (
+                    self.queue.qsize() >= self.batch_size * FILE_READ_AHEAD_BATCHES
+                    and not self.stopping
+                    and worker.is_alive()
+                ):
+                    sleep(0.05)
+                if not worker.is_alive():
+                    self.logger.error("Transcription stopped, giving up on the rest of %s", source.path)
+                    break
+                if self.stopping:
+                    break
+                self.send(self.clock.start + end, audio)
+        except Exception as e:
+            self.logger.error("failed to read %s: %s", source.path, e)
+        self.logger.info("Finished reading %.1f minutes of audio from %s", source.seconds_read / 60, source.path)
+        self.finished_reading.set()
+
     def start(self, callback: t.Callable[[str], None]) -> None:
+        if isinstance(self.source, AudioFileSource):
+            Thread(target=self._read_file, args=(self.source, current_thread()), daemon=True).start()
+            super().start(callback)
+            return
         with self.source:
             self.recorder.adjust_for_ambient_noise(self.source)
-        # This creates a separate thread for the audio recording,
-        # but it's non-blocking, so we just let it live here
-        self.recorder.listen_in_background(self.source, self.send, phrase_time_limit=self.phrase_timeout)
+        if self.stream_seconds > 0:
+            Thread(target=self._capture_forever, daemon=True).start()
+        else:
+            # This creates a separate thread for the audio recording,
+            # but it's non-blocking, so we just let it live here
+            self._stop_listening = self.recorder.listen_in_background(
+                self.source, self.on_phrase, phrase_time_limit=self.phrase_timeout
+            )
 
         super().start(callback)
+
+    def stop(self, drain: bool = True, timeout: float | None = None) -> bool:
+        if self._stop_listening is not None:
+            self._stop_listening(wait_for_stop=False)
+        if self.stream_seconds > 0 and drain:
+            self.send(_FLUSH)  # commit whatever's left in the window
+        return super().stop(drain, timeout)
@@ -1,14 +1,19 @@
+import hashlib
 import logging
 import typing as t
 from abc import abstractmethod
-from dataclasses import dataclass
+from concurrent.futures import Future
+from dataclasses import dataclass, field
 from functools import lru_cache
-from queue import Queue
-from time import sleep
+from queue import Empty, Queue
+from threading import Event
+from time import monotonic
 
 import requests
 import tiktoken
 
+from .metrics import metrics
+
 # Whisper's favorite phrase is "thank you", followed closely by "thanks for watching!".
 # We might miss legit transcriptions this way, but the frequency with which these phrases show up
 # without other dialogue is very low compared to the frequency with which whisper imagines them.
@@ -18,36 +23,52 @@ TRANSCRIPTION_HALLUCINATIONS = ["Thank you.", "Thanks for watching!", "I'm sorry
 @dataclass
 class Transcription:
     transcription: str
+    # time.time() when the audio was captured; carried along to everything made from it
+    timestamp: float | None = field(default=None, kw_only=True)
 
 
 @dataclass
 class Summary(Transcription):
     summary: str
+    # with rolling summaries, the notes on the scene that the next summary builds on
+    scene: str | None = field(default=None, kw_only=True)
 
     @classmethod
-    def from_transcription(cls, transcription: Transcription, summary: str) -> "Summary":
-        return cls(transcription.transcription, summary)
+    def from_transcription(cls, transcription: Transcription, summary: str, scene: str | None = None) -> "Summary":
+        return cls(transcription.transcription, summary, timestamp=transcription.timestamp, scene=scene)
 
 
 @dataclass
 class Image(Summary):
     image_bytes: bytes
+    # compressed and resized copies for viewers, keyed like "small.webp"; see imaging.make_variants
+    variants: t.Dict[str, bytes] = field(default_factory=dict, kw_only=True)
 
     @classmethod
     def from_summary(cls, summary: Summary, image_bytes: bytes) -> "Image":
-        return cls(summary.transcription, summary.summary, image_bytes)
+        return cls(
+            summary.transcription, summary.summary, image_bytes, timestamp=summary.timestamp, scene=summary.scene
+        )
+
+
+def image_etag(image_bytes: bytes) -> str:
+    """What the server tags an image with, so browsers only download it once"""
+    return hashlib.sha1(image_bytes).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def get_encoding(encoding_name: str = "cl100k_base") -> tiktoken.Encoding:
+    return tiktoken.get_encoding(encoding_name)
 
 
-@lru_cache(maxsize=2)
 def num_tokens_from_string(string: str, encoding_name: str = "cl100k_base") -> int:
     """Use OpenAI's tokenizer to count the number of tokens"""
-    encoding = tiktoken.get_encoding(encoding_name)
-    num_tokens = len(encoding.encode(string))
-    return num_tokens
+    return len(get_encoding(encoding_name).encode(string))
 
 
 def get_last_n_tokens(buffer: t.List[str], n: int) -> t.List[str]:
-    """Conservatively grabs the last n-ish tokens worth of lines from the buffer. Will undershoot."""
+    """Conservatively grabs the last n-ish tokens worth of lines from the buffer. Will undershoot.
+    Re-encodes the context once per line, so prefer TextBuffer's token index for anything large."""
     if not buffer:
         return []
     context: t.List[str] = []
@@ -76,38 +97,197 @@ def is_transcription_interesting(transcription: Transcription) -> bool:
 class AsyncThread:
     """Generic thread that has a work queue and a callback to run on the result"""
 
-    SLEEP_TIME = 0.25
+    # Workers block on the queue, so this only bounds how long an idle worker takes to notice stop()
+    STOP_CHECK_SECONDS = 5.0
     MAX_ERRORS = 5
 
+    _STOP = object()  # queued by stop() so that a blocked worker wakes up right away
+
     def __init__(self, logger_name="AsyncThread") -> None:
-        self.queue: Queue[t.Any] = Queue()
+        # Holds (time queued, item) pairs, so we can tell how long work sits around before it's picked up
+        self.queue: Queue[t.Tuple[float, t.Any]] = Queue()
         self._consecutive_errors: int = 0
+        self.batch_size: int = 1
+        # If work_batch fails on several items at once, they're retried one at a time, so one bad item (a garbled
+        # clip, say) doesn't take the rest of the batch down with it. Off for stages whose batches aren't
+        # independent items.
+        self.retry_failed_batches: bool = True
+        # With coalesce, only the newest of the items that have piled up is worked on and the rest are dropped.
+        # For stages where a newer item supersedes older ones, like summaries of the latest context.
+        self.coalesce: bool = False
+        self._stop_event = Event()
+        self._finished = Event()
+        self._finished.set()  # nothing to wait for until start() is called
         self.logger = logging.getLogger(logger_name)
+        self.stage: str = logger_name
+        metrics.set("stage_queue_depth", self.queue.qsize, stage=self.stage)
 
     @abstractmethod
     def work(self, *args) -> t.Any:
         raise NotImplementedError()
 
+    def for_table(self, table: str) -> None:
+        """Tells this stage's logs and metrics apart from the same stage at other tables, when one process is
+        hosting several. Call before starting it."""
+        metrics.unset("stage_queue_depth", stage=self.stage)
+        self.stage = f"{self.stage}.{table}"
+        self.logger = logging.getLogger(self.stage)
+        metrics.set("stage_queue_depth", self.queue.qsize, stage=self.stage)
+
     def start(self, callback) -> None:
-        while True:
-            if not self.queue.empty():
+        """Runs each queued item through work() as soon as it arrives, until stop() is called"""
+        self._finished.clear()
+        try:
+            while True:
+                try:
+                    queued = [self.queue.get(timeout=self.STOP_CHECK_SECONDS)]
+                except Empty:
+                    if self._stop_event.is_set():
+                        return
+                    continue
+                # if we've fallen behind, grab whatever else is already waiting (up to batch_size)
+                while (self.coalesce or len(queued) < self.batch_size) and queued[-1][1] is not self._STOP:
+                    try:
+                        queued.append(self.queue.get_nowait())
+                    except Empty:
+                        break
+                now = monotonic()
+                for queued_at, item in queued:
+                    if item is not self._STOP:
+                        metrics.observe("stage_wait_seconds", now - queued_at, stage=self.stage)
+                batch = [item for _, item in queued]
                 try:
-                    callback(self.work(*self.queue.get()))
-                    self._consecutive_errors = 0
-                except Exception as e:
-                    self._consecutive_errors += 1
-                    self.logger.error(e)
-                    if self._consecutive_errors > self.MAX_ERRORS:
-                        self.logger.critical("Abandoning execution after %d consecutive errors", self.MAX_ERRORS)
-                        exit(-1)
-            sleep(self.SLEEP_TIME)
+                    self._dispatch(callback, batch)
+                finally:
+                    for _ in batch:
+                        self.queue.task_done()
+                if batch[-1] is self._STOP:
+                    return
+        finally:
+            self._finished.set()
+
+    def work_batch(self, batch: t.List[t.Tuple[t.Any, ...]]) -> t.Iterable[t.Any]:
+        """Handles several queued items at once. Only called with more than one item when batch_size > 1,
+        and by default just works through them in order."""
+        for args in batch:
+            yield self.work(*args)
+
+    def _dispatch(self, callback, batch: t.List[t.Any]) -> None:
+        """Sends queued items to the callback, except for ones from submit(), which go to their futures"""
+        pending: t.List[t.Tuple[t.Any, ...]] = []
+        for item in batch:
+            if isinstance(item, _Request):
+                if pending:
+                    self._process(callback, pending)
+                    pending = []
+                self._resolve(item)
+            elif item is not self._STOP:
+                pending.append(item)
+        if pending:
+            if self.coalesce and len(pending) > 1:
+                self.logger.info("Dropping %d stale items in favor of the newest", len(pending) - 1)
+                metrics.inc("stage_dropped_total", len(pending) - 1, stage=self.stage)
+                pending = pending[-1:]
+            self._process(callback, pending)
+
+    def _resolve(self, request: "_Request") -> None:
+        if not request.future.set_running_or_notify_cancel():
+            return
+        start = monotonic()
+        try:
+            request.future.set_result(self.work(*request.args))
+        except Exception as e:
+            metrics.inc("stage_errors_total", stage=self.stage)
+            self.logger.error(e)
+            request.future.set_exception(e)
+        finally:
+            metrics.observe("stage_work_seconds", monotonic() - start, stage=self.stage)
+            metrics.inc("stage_items_total", stage=self.stage)
+
+    def _process(self, callback, batch: t.List[t.Tuple[t.Any, ...]]) -> None:
+        start = monotonic()
+        try:
+            # the default work_batch just calls work() on each item in turn, so each can fail on its own
+            groups = [[args] for args in batch] if type(self).work_batch is AsyncThread.work_batch else [batch]
+            failed = sum(self._work_and_callback(callback, group) for group in groups)
+        finally:
+            metrics.observe("stage_work_seconds", monotonic() - start, stage=self.stage)
+            metrics.inc("stage_items_total", len(batch), stage=self.stage)
+        if failed < len(batch):
+            self._consecutive_errors = 0
+        else:
+            self._consecutive_errors += 1
+            if self._consecutive_errors > self.MAX_ERRORS:
+                self.logger.critical("Abandoning execution after %d consecutive errors", self.MAX_ERRORS)
+                exit(-1)
+
+    def _work_and_callback(self, callback, batch: t.List[t.Tuple[t.Any, ...]]) -> int:
+        """Runs the batch through work_batch and hands each result to the callback. Returns how many items failed."""
+        try:
+            results = list(self.work_batch(batch))
+        except Exception as e:
+            if len(batch) == 1 or not self.retry_failed_batches:
+                self._record_error(e, len(batch))
+                return len(batch)
+            self.logger.warning("A batch of %d failed (%s), retrying them one at a time", len(batch), e)
+            return sum(self._work_and_callback(callback, [args]) for args in batch)
+        failed = 0
+        for result in results:
+            try:
+                callback(result)
+            except Exception as e:
+                self._record_error(e)
+                failed += 1
+        return failed
+
+    def _record_error(self, error: Exception, items: int = 1) -> None:
+        metrics.inc("stage_errors_total", items, stage=self.stage)
+        self.logger.error(error)
 
     def send(self, *args) -> None:
-        self.queue.put(args)
+        if self._stop_event.is_set():
+            self.logger.debug("Stopped, dropping new work")
+            return
+        self.queue.put((monotonic(), args))
+
+    def submit(self, *args) -> "Future[t.Any]":
+        """Like send, but the result comes back through the returned future instead of the callback"""
+        request = _Request(args, Future())
+        if self._stop_event.is_set():
+            request.future.cancel()
+        else:
+            self.queue.put((monotonic(), request))
+        return request.future
+
+    def stop(self, drain: bool = True, timeout: float | None = None) -> bool:
+        """Asks the worker to exit. With drain, everything already queued is processed first; otherwise
+        pending work is thrown away and only the item in progress is finished. Returns False if the worker
+        was still busy after `timeout` seconds."""
+        self._stop_event.set()
+        if not drain:
+            try:
+                while True:
+                    if isinstance(item := self.queue.get_nowait()[1], _Request):
+                        item.future.cancel()
+                    self.queue.task_done()
+            except Empty:
+                pass
+        self.queue.put((monotonic(), self._STOP))
+        return self._finished.wait(timeout)
+
+    @property
+    def stopping(self) -> bool:
+        return self._stop_event.is_set()
+
+
+@dataclass
+class _Request:
+    args: t.Tuple[t.Any, ...]
+    future: "Future[t.Any]"
 
 
-def download_image(url: str) -> bytes:
-    r = requests.get((url), stream=True)
+def download_image(url: str, timeout: float | None = None) -> bytes:
+    r = requests.get((url), stream=True, timeout=timeout)
     out = bytes()
     if r.status_code == 200:
         for chunk in r:
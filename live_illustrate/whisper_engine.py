@@ -0,0 +1,326 @@
+import logging
+import os
+import typing as t
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+from threading import Condition, Event, Lock, Thread
+from time import perf_counter
+
+import numpy as np
+
+from .metrics import metrics
+
+SAMPLE_RATE = 16000
+MAX_CHUNK_SECONDS = 30  # Whisper's input window; longer stretches of speech get split by the VAD
+MIN_SILENCE_MS = 500
+
+Segment = t.Tuple[float, float, str]
+
+
+class WhisperEngine:
+    """Holds a faster-whisper model in memory for the life of the process and transcribes VAD-segmented
+    chunks of one or more phrases in a single batched decode"""
+
+    def __init__(
+        self,
+        model: str,
+        compute_type: str,
+        batch_size: int = 8,
+        device: str = "auto",
+        cpu_threads: int = 0,
+        background: bool = False,
+    ) -> None:
+        self.logger = logging.getLogger("WhisperEngine")
+        self.model_name: str = model
+        self.compute_type: str = compute_type
+        self.batch_size: int = batch_size
+        self.language: str | None = "en" if model.endswith(".en") else None
+        self._lock = Lock()  # the pipeline keeps a little state between calls
+
+        # faster-whisper (and ctranslate2 under it) take a while to import, and the model a while longer to load,
+        # so with background they're left to a thread and transcription waits for them the first time through
+        self._loaded = Event()
+        self._load_error: Exception | None = None
+        if background:
+            Thread(target=self._load, args=(device, cpu_threads), name="WhisperEngine", daemon=True).start()
+        else:
+            self._load(device, cpu_threads)
+            self.wait_until_loaded()
+
+    def _load(self, device: str, cpu_threads: int) -> None:
+        start = perf_counter()
+        try:
+            from faster_whisper import (  # type: ignore
+                BatchedInferencePipeline,
+                WhisperModel,
+            )
+            from faster_whisper.vad import VadOptions  # type: ignore
+
+            self.vad_options = VadOptions(
+                max_speech_duration_s=MAX_CHUNK_SECONDS, min_silence_duration_ms=MIN_SILENCE_MS
+            )
+            self.model = WhisperModel(
+                self.model_name, device=device, compute_type=self.compute_type, cpu_threads=cpu_threads
+            )
+            self.pipeline = BatchedInferencePipeline(model=self.model)
+            self.logger.info("Loaded %s (%s) in %.1fs", self.model_name, self.compute_type, perf_counter() - start)
+        except Exception as e:
+            self.logger.error("Failed to load %s: %s", self.model_name, e)
+            self._load_error = e
+        finally:
+            self._loaded.set()
+
+    def wait_until_loaded(self) -> None:
+        """Blocks until the model is ready, and raises whatever went wrong if it couldn't be loaded"""
+        self._loaded.wait()
+        if self._load_error is not None:
+            raise self._load_error
+
+    def transcribe(self, audio: np.ndarray) -> str:
+        return self.transcribe_batch([audio])[0]
+
+    def transcribe_batch(self, phrases: t.Sequence[np.ndarray]) -> t.List[str]:
+        """Transcribes several phrases (16kHz mono float32) at once. Silence is cut out by the VAD and the
+        remaining speech chunks are decoded together, so a backlog costs roughly one pass instead of many."""
+        self.wait_until_loaded()
+        offsets: t.List[int] = []
+        clips: t.List[t.Dict[str, float]] = []
+        position = 0
+        for phrase in phrases:
+            offsets.append(position)
+            clips.extend(self._speech_clips(phrase, position))
+            position += len(phrase)
+
+        texts: t.List[t.List[str]] = [[] for _ in phrases]
+        for start, _end, text in self._decode(np.concatenate(phrases), clips, len(phrases)):
+            texts[max(0, bisect_right(offsets, start * SAMPLE_RATE) - 1)].append(text)
+        return [" ".join(text) for text in texts]
+
+    def transcribe_segments(self, audio: np.ndarray) -> t.List[Segment]:
+        """(start, end, text) for each chunk of speech the VAD finds in the audio, with times in seconds"""
+        self.wait_until_loaded()
+        return self._decode(audio, self._speech_clips(audio, 0), 1)
+
+    def _speech_clips(self, audio: np.ndarray, offset: int) -> t.List[t.Dict[str, float]]:
+        from faster_whisper.vad import get_speech_timestamps  # type: ignore
+
+        return [
+            {"start": (offset + speech["start"]) / SAMPLE_RATE, "end": (offset + speech["end"]) / SAMPLE_RATE}
+            for speech in get_speech_timestamps(audio, self.vad_options, sampling_rate=SAMPLE_RATE)
+        ]
+
+    def _decode(self, audio: np.ndarray, clips: t.List[t.Dict[str, float]], phrase_count: int) -> t.List[Segment]:
+        audio_seconds = len(audio) / SAMPLE_RATE
+        if not clips:
+            self.logger.debug("No speech found in %.1fs of audio", audio_seconds)
+            return []
+
+        start = perf_counter()
+        with self._lock:
+            segments, _info = self.pipeline.transcribe(
+                audio, language=self.language, clip_timestamps=clips, batch_size=self.batch_size
+            )
+            decoded = [(segment.start, segment.end, segment.text.strip()) for segment in segments]
+        elapsed = perf_counter() - start
+
+        self.logger.info(
+            "Transcribed %d phrase(s), %.1fs of audio in %.1fs (real-time factor %.2f)",
+            phrase_count,
+            audio_seconds,
+            elapsed,
+            elapsed / audio_seconds if audio_seconds else 0.0,
+        )
+        return decoded
+
+
+class WhisperPool:
+    """Runs a WhisperEngine in each of several worker processes so that a backlog of phrases is decoded on
+    all cores at once. Audio is handed over through shared memory rather than pickled."""
+
+    def __init__(
+        self,
+        workers: int,
+        model: str,
+        compute_type: str,
+        batch_size: int = 8,
+        device: str = "auto",
+        background: bool = False,
+    ) -> None:
+        self.logger = logging.getLogger("WhisperPool")
+        self.workers: int = workers
+        # split the cores between the workers instead of letting each one assume it has the whole machine
+        cpu_threads = max(1, (os.cpu_count() or workers) // workers)
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=get_context("spawn"),  # don't fork a process that's already running threads
+            initializer=_init_worker,
+            initargs=(model, compute_type, batch_size, device, cpu_threads),
+        )
+        # Work submitted before the workers have loaded their models just waits for them. Without background,
+        # block until every worker is ready, so the first phrase doesn't pay for it.
+        self._ready = [self.executor.submit(_worker_ready) for _ in range(workers)]
+        if background:
+            Thread(target=self._log_when_ready, args=(perf_counter(),), name="WhisperPool", daemon=True).start()
+        else:
+            self._log_when_ready(perf_counter())
+
+    def _log_when_ready(self, start: float) -> None:
+        try:
+            self.wait_until_loaded()
+            self.logger.info("Started %d transcription workers in %.1fs", self.workers, perf_counter() - start)
+        except Exception as e:
+            self.logger.error("Transcription workers failed to start: %s", e)
+
+    def wait_until_loaded(self) -> None:
+        for future in self._ready:
+            future.result()
+
+    def transcribe(self, audio: np.ndarray) -> str:
+        return self.transcribe_batch([audio])[0]
+
+    def transcribe_batch(self, phrases: t.Sequence[np.ndarray]) -> t.List[str]:
+        """Splits the phrases into one contiguous group per worker and returns the results in the same order
+        the phrases were given in"""
+        per_worker = -(-len(phrases) // self.workers)  # ceiling division
+        groups = [phrases[i : i + per_worker] for i in range(0, len(phrases), per_worker)]
+
+        buffers: t.List[SharedMemory] = []
+        futures: t.List[Future[t.List[str]]] = []
+        try:
+            for group in groups:
+                buffers.append(shm := _share(np.concatenate(group)))
+                futures.append(self.executor.submit(_transcribe_shared, shm.name, [len(p) for p in group]))
+            return [text for future in futures for text in future.result()]
+        finally:
+            for shm in buffers:
+                shm.close()
+                shm.unlink()
+
+    def transcribe_segments(self, audio: np.ndarray) -> t.List[Segment]:
+        shm = _share(audio)
+        try:
+            return self.executor.submit(_transcribe_segments_shared, shm.name, len(audio)).result()
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(cancel_futures=True)
+
+
+class FairScheduler:
+    """Shares one WhisperEngine or WhisperPool between the tables of a multi-table process. Each table transcribes
+    through its own handle (see for_table), which queues the work here. Whenever the engine is free, the waiting
+    table that has used the least decode time so far goes next, so a talkative table can't starve the others."""
+
+    def __init__(self, engine: WhisperEngine | WhisperPool, concurrency: int = 1) -> None:
+        self.logger = logging.getLogger("FairScheduler")
+        self.engine = engine
+        self.used: t.Dict[str, float] = {}  # seconds of decoding done for each table
+        self._waiting: t.Dict[str, t.Deque[t.Tuple[t.Callable[..., t.Any], t.Tuple[t.Any, ...], Future[t.Any]]]] = {}
+        self._progress: float = 0.0  # decode time used by the last table to be picked
+        self._changed = Condition()
+        for number in range(max(1, concurrency)):
+            Thread(target=self._run_forever, name=f"FairScheduler-{number}", daemon=True).start()
+
+    def for_table(self, table: str) -> "TableEngine":
+        with self._changed:
+            self.used.setdefault(table, 0.0)
+            self._waiting.setdefault(table, deque())
+        return TableEngine(self, table)
+
+    def submit(self, table: str, method: t.Callable[..., t.Any], *args: t.Any) -> "Future[t.Any]":
+        future: Future[t.Any] = Future()
+        with self._changed:
+            if not self._waiting[table]:
+                # a table that's been quiet for a while doesn't get to make up for it by hogging the engine
+                self.used[table] = max(self.used[table], self._progress)
+            self._waiting[table].append((method, args, future))
+            self._changed.notify()
+        return future
+
+    def _run_forever(self) -> None:
+        while True:
+            with self._changed:
+                self._changed.wait_for(lambda: any(self._waiting.values()))
+                table = min((table for table, jobs in self._waiting.items() if jobs), key=self.used.__getitem__)
+                method, args, future = self._waiting[table].popleft()
+                self._progress = self.used[table]
+            if not future.set_running_or_notify_cancel():
+                continue
+            start = perf_counter()
+            try:
+                future.set_result(method(*args))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                elapsed = perf_counter() - start
+                with self._changed:
+                    self.used[table] += elapsed
+                metrics.inc("engine_seconds_total", elapsed, table=table)
+
+
+class TableEngine:
+    """One table's handle on a FairScheduler, which stands in for the engine it shares"""
+
+    def __init__(self, scheduler: FairScheduler, table: str) -> None:
+        self.scheduler = scheduler
+        self.table: str = table
+
+    def wait_until_loaded(self) -> None:
+        self.scheduler.engine.wait_until_loaded()
+
+    def transcribe(self, audio: np.ndarray) -> str:
+        return self.transcribe_batch([audio])[0]
+
+    def transcribe_batch(self, phrases: t.Sequence[np.ndarray]) -> t.List[str]:
+        return self.scheduler.submit(self.table, self.scheduler.engine.transcribe_batch, phrases).result()
+
+    def transcribe_segments(self, audio: np.ndarray) -> t.List[Segment]:
+        return self.scheduler.submit(self.table, self.scheduler.engine.transcribe_segments, audio).result()
+
+
+_worker_engine: WhisperEngine | None = None
+
+
+def _init_worker(model: str, compute_type: str, batch_size: int, device: str, cpu_threads: int) -> None:
+    global _worker_engine
+    _worker_engine = WhisperEngine(model, compute_type, batch_size=batch_size, device=device, cpu_threads=cpu_threads)
+
+
+def _worker_ready() -> bool:
+    return _worker_engine is not None
+
+
+def _share(audio: np.ndarray) -> SharedMemory:
+    shm = SharedMemory(create=True, size=max(1, audio.nbytes))
+    np.ndarray(audio.shape, dtype=np.float32, buffer=shm.buf)[:] = audio
+    return shm
+
+
+def _read_shared(name: str, length: int) -> np.ndarray:
+    shm = SharedMemory(name=name)  # the parent owns this buffer and unlinks it once we're done
+    try:
+        return np.ndarray((length,), dtype=np.float32, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+
+
+def _transcribe_shared(name: str, lengths: t.List[int]) -> t.List[str]:
+    assert _worker_engine is not None, "worker was not initialized"
+    audio = _read_shared(name, sum(lengths))
+    offsets = np.cumsum([0] + lengths)
+    return _worker_engine.transcribe_batch([audio[start:end] for start, end in zip(offsets[:-1], offsets[1:])])
+
+
+def _transcribe_segments_shared(name: str, length: int) -> t.List[Segment]:
+    assert _worker_engine is not None, "worker was not initialized"
+    return _worker_engine.transcribe_segments(_read_shared(name, length))
+
+
+def audio_to_array(raw_pcm: bytes) -> np.ndarray:
+    """Converts 16-bit little-endian mono PCM into the float32 samples Whisper expects"""
+    return np.frombuffer(raw_pcm, dtype=np.int16).astype(np.float32) / 32768.0